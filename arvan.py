@@ -10,15 +10,23 @@ PLOTTING RESULTS OF ALPGM-J2K SIMULATIONS FOR THE ARVAN GLACIERIZED CATCHMENT
 """
 
 from pathlib import Path
-import os
+import os, sys
 import numpy as np
 import pandas as pd
 import subprocess
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-import proplot as plot
 import copy
-from hydroeval import evaluator, kge, rmse, nse
+import io
+import glob
+import argparse
+import multiprocessing
+import hashlib
+import inspect
+import json
+from metrics import evaluate_runs, evaluate_seasons
+
+# matplotlib and proplot are only imported when plotting (see load_plotting)
+plt = None
+plot = None
 
 # Paths
 
@@ -29,367 +37,599 @@ j2k_updated_output_path = os.path.join(workspace, 'J2K_output')
 arvan_obs_path = "C:\Jordi\PhD\J2K\Data\Arvan"
 smb_path = os.path.join(arvan_obs_path, 'saint_sorlin')
 
-###############################################################################
-###                           FUNCTIONS                                     ###
-###############################################################################
-
-
-
-###############################################################################
-###                           MAIN                                          ###
-###############################################################################
-
-# Read TimeLoop J2K output
-# Remove useless header lines
-raw_time_loop = pd.read_csv(os.path.join(j2k_output_path, 'TimeLoop.dat'), sep="\t", skiprows=[0,1,2,3,4,6,7,8,9,10], skipfooter=1)
-n_cols = raw_time_loop.columns.size
-raw_time_loop.to_csv(os.path.join(j2k_updated_output_path, "TimeLoop_clean.dat"), sep="\t")
-
-# Parse cleaned up version
-time_loop = pd.read_csv(os.path.join(j2k_updated_output_path, "TimeLoop_clean.dat"), sep="\t", index_col=1, usecols=range(0,n_cols))
-time_loop.index =  pd.to_datetime(time_loop.index, infer_datetime_format=True)
-#time_loop.index = time_loop.index.to_numpy()
-
-# Open and parse Arvan hydrological observations
-arvan_obs = pd.read_csv(os.path.join(arvan_obs_path, "W1055020_qj_hydro2.txt"), sep=";", skiprows=range(0,3), skipfooter=1, 
-                        names=['freq', 'ID', 'date', 'runoff', 'mode', 'confidence'], index_col=2, usecols=range(0,6))
-
-arvan_obs.index =  pd.to_datetime(arvan_obs.index, format='%Y%m%d')
-
-### Fill empty dates with nan
-
-idx = pd.date_range(arvan_obs.index[0], arvan_obs.index[-1])
-
-arvan_obs.index = pd.DatetimeIndex(arvan_obs.index)
+# TimeLoop.dat layout: 5 header lines, the column names, 5 more header lines, the daily data and a closing line.
+# The parsed data is cached in a binary copy, reused as long as TimeLoop.dat is not modified
+time_loop_header_lines = 11
+time_loop_date_format = '%Y-%m-%d %H:%M'
+time_loop_cache_path = os.path.join(j2k_updated_output_path, 'TimeLoop_cache.npz')
 
-arvan_obs = arvan_obs.reindex(idx, fill_value=np.nan)
+# Ensemble mode: J2K output folders (or glob patterns) processed across n_workers processes,
+# with the statistics and metrics of all runs saved in a single tidy table
+n_workers = multiprocessing.cpu_count()
+ensemble_summary_path = os.path.join(j2k_updated_output_path, 'ensemble_summary.csv')
 
-# We crop both dataframes for the same period
-time_loop = time_loop.loc[arvan_obs.index[0]:arvan_obs.index[-1]]
-arvan_obs = arvan_obs.loc[arvan_obs.index[0]:time_loop.index[-1]]
-
-# Convert sim runoff to L/s
-time_loop['catchmentSimRunoff'] = time_loop['catchmentSimRunoff']/86400
-time_loop['glacierRunoff'] = time_loop['glacierRunoff']/86400
-time_loop['iceRunoff'] = time_loop['iceRunoff']/86400
-time_loop['rainRunoff'] = time_loop['rainRunoff']/86400
-
-# Choose subset of dates for plots
-time_loop = time_loop.loc[time_loop.index > '2000-10-01'][1:]
-arvan_obs = arvan_obs.loc[arvan_obs.index > '2000-10-01']
-
-# We load the season MB data for Saint Sorlin glacier
-sorlin_seasonal_mb = pd.read_csv(os.path.join(smb_path, "st_sorlin_seasonal_mb.csv"), sep=";")
-
-sorlin_seasonal_mb['summer L'] = sorlin_seasonal_mb['Summer']*sorlin_seasonal_mb['Surface (m2)']*1000
-sorlin_seasonal_mb['winter L'] = sorlin_seasonal_mb['Winter']*sorlin_seasonal_mb['Surface (m2)']*1000
-
-sorlin_seasonal_mb['annual L'] = sorlin_seasonal_mb['Annual']*sorlin_seasonal_mb['Surface (m2)']*1000
-
-# De-accumulate massBalance and convert it to seasonal and annual series
-#j2k_mb_non_cumulative = time_loop['massBalance'].diff()
-
-time_loop['MB_nc'] = time_loop['massBalance']
-#time_loop['MB_nc'] = j2k_mb_non_cumulative
-#time_loop['MB_nc'] = time_loop['MB_nc'].interpolate()
+# Headless rendering: each figure is drawn in a worker process on the Agg backend, and skipped if
+# its input series and plotting code have not changed since its PDF was written (hashes saved in the plots folder)
+figure_hashes_file = 'figure_hashes.json'
 
+# Hydrological seasons
 SeasonDict = {11: 'Winter', 12: 'Winter', 1: 'Winter', 2: 'Winter', 3: 'Winter', 4: 'Winter', 5: 'Summer', 6: 'Summer', 7: 'Summer', \
 8: 'Summer', 9: 'Summer', 10: 'Winter'}
+season_names = sorted(set(SeasonDict.values()))
 
-j2k_seasonal_MB = time_loop['MB_nc'].groupby([lambda x: SeasonDict[x.month], time_loop.index.year]).sum()
-j2k_annual_MB = time_loop['MB_nc'].groupby(time_loop.index.year).sum()
-j2k_annual_MB = j2k_annual_MB.loc[j2k_annual_MB.index > 2000]
-
-years = np.asarray(range(2000, 2013))    
-
-# De-accumulate temperature
-#j2k_tmean_non_cumulative = time_loop['tmean_glacier'].diff()
-time_loop['tmean_nc'] = time_loop['tmean_glacier']
-
-#time_loop['tmean_nc'] = j2k_tmean_non_cumulative
-#time_loop['tmean_nc'] = time_loop['tmean_nc'].interpolate()
-
-# Calculate seasonal snow and mean temperature
-j2k_seasonal_snow = time_loop['netSnow_glacier'].groupby([lambda x: SeasonDict[x.month], time_loop.index.year]).sum()
-j2k_seasonal_rain = time_loop['netRain_glacier'].groupby([lambda x: SeasonDict[x.month], time_loop.index.year]).sum()
-j2k_seasonal_meanTemp = time_loop['tmean_nc'].groupby([lambda x: SeasonDict[x.month], time_loop.index.year]).mean()
-
-j2k_annual_snow = time_loop['netSnow_glacier'].groupby(time_loop.index.year).sum()
-j2k_annual_snow = j2k_annual_snow.loc[j2k_annual_snow.index > 2000]
-j2k_annual_rain = time_loop['netRain_glacier'].groupby(time_loop.index.year).sum()
-j2k_annual_rain = j2k_annual_rain.loc[j2k_annual_rain.index > 2000]
-j2k_annual_meanTemp = time_loop['tmean_nc'].groupby(time_loop.index.year).mean()
-j2k_annual_meanTemp = j2k_annual_meanTemp.loc[j2k_annual_meanTemp.index > 2000]
-
-##### SEASONAL RUNOFF COMPUTATION  #####
-
-#import pdb; pdb.set_trace()
-
-time_loop['noGlacierRunoff'] = time_loop['catchmentSimRunoff'] - time_loop['glacierRunoff']
-time_loop['netGlacierRunoff'] = time_loop['glacierRunoff'] - time_loop['rainRunoff']
+# Statistics of the TimeLoop variables at each resolution: 'seasonal' (season and year), 'annual' (year) and 'monthly' (month of the year).
+# All the variables of a resolution are reduced together, so adding a variable does not add a pass over the data
+time_loop_aggregations = {'seasonal': {'MB_nc': ['sum'], 'netSnow_glacier': ['sum'], 'netRain_glacier': ['sum'], 'tmean_nc': ['mean'], 
+                                       'catchmentSimRunoff': ['mean'], 'noGlacierRunoff': ['mean'], 'iceRunoff': ['mean']},
+                          'annual': {'MB_nc': ['sum'], 'netSnow_glacier': ['sum'], 'netRain_glacier': ['sum'], 'tmean_nc': ['mean']},
+                          'monthly': {'catchmentSimRunoff': ['mean'], 'noGlacierRunoff': ['mean']}}
 
-j2k_seasonal_total_runoff = time_loop['catchmentSimRunoff'].groupby([lambda x: SeasonDict[x.month], time_loop.index.year]).mean()
-j2k_seasonal_noGlacier_runoff = time_loop['noGlacierRunoff'].groupby([lambda x: SeasonDict[x.month], time_loop.index.year]).mean()
-j2k_seasonal_glacier_runoff = time_loop['iceRunoff'].groupby([lambda x: SeasonDict[x.month], time_loop.index.year]).mean()
-j2k_seasonal_glacier_contribution = (j2k_seasonal_glacier_runoff/j2k_seasonal_total_runoff)*100
-
-j2K_monthly_obs_runoff = arvan_obs['runoff'].groupby(time_loop.index.month).mean()
-j2K_monthly_total_runoff = time_loop['catchmentSimRunoff'].groupby(time_loop.index.month).mean()
-j2K_monthly_noGlacier_runoff = time_loop['noGlacierRunoff'].groupby(time_loop.index.month).mean()
-
-j2K_daily_ice_contribution = (time_loop['iceRunoff']/time_loop['catchmentSimRunoff'])*100
-j2K_monthly_ice_contribution = j2K_daily_ice_contribution.resample('M').mean()
-j2k_annual_ice_contribution = j2K_daily_ice_contribution.resample('Y').mean()
-
-j2K_daily_glacier_contribution = (time_loop['glacierRunoff']/time_loop['catchmentSimRunoff'])*100
-j2K_monthly_glacier_contribution = j2K_daily_glacier_contribution.resample('M').mean()
-j2k_annual_glacier_contribution = j2K_daily_glacier_contribution.resample('Y').mean()
-
-#############  COMPUTE J2K PERFORMANCE  ##############
-
-### Kling-Gupta Efficiency (objective function 1)
-kge_j2k = evaluator(kge, time_loop['catchmentSimRunoff'].values, arvan_obs['runoff'].values)[0][0]
-kge_j2k_no_glacier = evaluator(kge, time_loop['noGlacierRunoff'].values, arvan_obs['runoff'].values)[0][0]
-
-# Nash-Sutcliffe Efficiency (nse)
-nse_j2k = evaluator(nse, time_loop['catchmentSimRunoff'].values, arvan_obs['runoff'].values)[0]
-nse_j2k_no_glacier = evaluator(nse, time_loop['noGlacierRunoff'].values, arvan_obs['runoff'].values)[0]
-
-print("\nJ2K KGE with glacier: " + str(kge_j2k))
-print("\nJ2K NSE with glacier: " + str(nse_j2k))
-
-print("\nJ2K KGE without glacier: " + str(kge_j2k_no_glacier))
-print("\nJ2K NSE without glacier: " + str(nse_j2k_no_glacier))
-
-#import pdb; pdb.set_trace()
-
-####################################################################################
-####  PLOT J2K VS OBS RUNOFF  ######################################################
-####################################################################################
-
-fig1, axs1 = plot.subplots(ncols=1, nrows=3, aspect=3, axwidth=6)
-
-axs1[0].plot(time_loop.index, arvan_obs['runoff'], linewidth=0.1, c='black', label="Observations", legend='ur')
-axs1[0].plot(time_loop.index, time_loop['catchmentSimRunoff'], linewidth=0.1, c='sienna', label="J2K", legend='ur')
-#axs1[0].set_ylim(0, 15000)
-
-axs1[1].plot(time_loop.index, time_loop['catchmentSimRunoff'].values - arvan_obs['runoff'].values, linewidth=0.1, c='darkred', label="J2K daily bias", legend='ur')
-#axs1[1].set_ylim(-10000, 10000)
-
-axs1[2].plot(time_loop.index, time_loop['catchmentSimRunoff'].values, linewidth=0.1, c='sienna', label="Observations", legend='ur')
-axs1[2].plot(time_loop.index, time_loop['iceRunoff'], linewidth=0.5, c='denim', label="J2K glacier runoff", legend='ur')
-#axs1[2].plot(time_loop.index, time_loop['rainRunoff'], linewidth=0.1, c='denim', label="J2K rain runoff", legend='ur')
-#axs1[2].plot(time_loop.index, time_loop['iceRunoff'], linewidth=0.1, c='denim', label="J2K ice runoff", legend='ur')
-
-axs1.format(
-            abc=True, abcloc='ul',
-            ygridminor=True,
-            ytickloc='both', yticklabelloc='left',
-            xlabel='Date', ylabel='Runoff (L/s)'
-            )
-
-fig1.savefig(os.path.join(plots_path, 'arvan_j2k_vs_obs_runoff.pdf'))
-#subprocess.Popen(os.path.join(plots_path, 'arvan_j2k_vs_obs_runoff.pdf'),shell=True)
-
-######  PLOT DAILY MASS BALANCE  #################
-
-fig2, axs2 = plot.subplots(ncols=1, nrows=4, axwidth=2, aspect=2, share=1)
-
-axs2[0].plot(time_loop.index, np.cumsum(time_loop['massBalance'].values), linewidth=1, c='steelblue')
-axs2[0].set_ylabel('m.w.e.')
-axs2[0].format(title='Cumulative daily MB')
-axs2[1].plot(j2k_annual_MB.index, j2k_seasonal_MB['Winter'][1:] + j2k_seasonal_MB['Summer'], linewidth=1, c='steelblue')
-axs2[1].set_ylabel('m.w.e. d$^{-1}$')
-axs2[1].axhline(y=0, color='black', linewidth=0.7, linestyle='-')
-axs2[1].format(title='Annual MB')
-axs2[2].plot(j2k_annual_meanTemp.index.values[1:-1], j2k_seasonal_meanTemp['Winter'][2:-1] + j2k_seasonal_meanTemp['Summer'].values[1:-1], linewidth=1, c='darkred')
-axs2[2].set_ylabel('°C')
-axs2[2].format(title='Annual mean temperature')
-axs2[3].plot(j2k_annual_snow.index.values[1:-1], j2k_seasonal_snow['Winter'][2:-1] + j2k_seasonal_snow['Summer'][1:-1], linewidth=1, c='skyblue')
-axs2[3].set_ylabel('mm')
-axs2[3].format(title='Annual snowfall')
-
-axs2.format(
-#            abc=True, abcloc='ul',
-            ygridminor=True,
-            ytickloc='both', yticklabelloc='left',
-            xlabel='Date'
-            )
-
-fig2.savefig(os.path.join(plots_path, 'arvan_runoff_mb_climate.pdf'))
-#subprocess.Popen(os.path.join(plots_path, 'arvan_runoff_mb_climate.pdf'),shell=True)
-
-######  PLOT SEASONAL MASS BALANCE VALIDATION #################
-
-fig3, axs3 = plot.subplots([[1, 1],[2, 3],[4, 5],[6, 7],[8, 9]], ncols=2, nrows=5, aspect=4, axwidth=4, spany=0)
-
-axs3[0].format(title='Annual glacier-wide MB')
-axs3[0].set_ylabel('L')
-axs3[0].axhline(y=0, color='black', linewidth=0.7, linestyle='-')
-h5 = axs3[0].plot(sorlin_seasonal_mb['Year'].values, sorlin_seasonal_mb['annual L'].values, linewidth=3, c='black', label="GLACIOCLIM annual MB")
-h6 = axs3[0].plot(j2k_annual_MB.index.values[1:-1], j2k_annual_MB.values[1:-1], linewidth=3, c='olive', label="J2K annual MB")
-
-axs3[1].axhline(y=0, color='black', linewidth=0.7, linestyle='-')
-axs3[1].format(title='Winter MB')
-axs3[1].set_ylabel('L')
-h1 = axs3[1].plot(sorlin_seasonal_mb['Year'].values[1:-1], sorlin_seasonal_mb['winter L'].values[1:-1], linewidth=3, c='darkblue', label="GLACIOCLIM winter MB")
-h2 = axs3[1].plot(j2k_seasonal_MB['Winter'].index.values[1:-1], j2k_seasonal_MB['Winter'].values[1:-1], linewidth=3, c='skyblue', label="J2K winter MB")
-axs3[3].format(title='Winter snowfall')
-axs3[3].set_ylabel('mm')
-axs3[3].plot(j2k_annual_MB.index.values[:-1], j2k_seasonal_snow['Winter'].values[1:-1], linewidth=2, c='skyblue')
-axs3[5].format(title='Winter rainfall')
-axs3[5].set_ylabel('mm')
-axs3[5].plot(j2k_annual_MB.index.values[:-1], j2k_seasonal_rain['Winter'].values[1:-1], linewidth=2, c='steelblue')
-axs3[7].format(title='Winter mean temperature')
-axs3[7].set_ylabel('°C')
-axs3[7].axhline(y=0, color='black', linewidth=0.7, linestyle='-')
-axs3[7].plot(j2k_annual_meanTemp.index.values[:-1], j2k_seasonal_meanTemp['Winter'].values[1:-1], linewidth=2, c='crimson')
-
-axs3[2].axhline(y=0, color='black', linewidth=0.7, linestyle='-')
-axs3[2].format(title='Summer MB')
-axs3[2].set_ylabel('L')
-h3 = axs3[2].plot(sorlin_seasonal_mb['Year'].values[1:-1], sorlin_seasonal_mb['summer L'].values[1:-1], linewidth=3, c='darkred', label="GLACIOCLIM summer MB")
-h4 = axs3[2].plot(j2k_seasonal_MB['Summer'].index.values[:-1], j2k_seasonal_MB['Summer'].values[:-1], linewidth=3, c='sienna', label="J2K summer MB")
-axs3[4].format(title='Summer snowfall')
-axs3[4].set_ylabel('mm')
-axs3[4].plot(j2k_annual_MB.index.values[:-1], j2k_seasonal_snow['Summer'].values[:-1], linewidth=2, c='skyblue')
-axs3[6].format(title='Summer rainfall')
-axs3[6].set_ylabel('mm')
-axs3[6].plot(j2k_annual_MB.index.values[:-1], j2k_seasonal_rain['Summer'].values[:-1], linewidth=2, c='steelblue')
-axs3[8].format(title='Summer mean temperature')
-axs3[8].set_ylabel('°C')
-axs3[8].axhline(y=0, color='black', linewidth=0.7, linestyle='-')
-axs3[8].plot(j2k_annual_meanTemp.index.values[:-1], j2k_seasonal_meanTemp['Summer'].values[:-1], linewidth=2, c='crimson')
-
-fig3.legend(((h5,h6,h1,h2,h3,h4)), loc='r', ncols=1, frame=True)
-
-axs3.format(
-            abc=True, abcloc='ur',
-            ygridminor=True,
-            ytickloc='both', yticklabelloc='left',
-            xlabel='Year'
-            )
-
-fig3.savefig(os.path.join(plots_path, 'seasonal_mb.pdf'))
-#subprocess.Popen(os.path.join(plots_path, 'seasonal_mb.pdf'),shell=True)
-
-#########################################
-
-### ANNUAL MASS BALANCES  #################
-
-#import pdb; pdb.set_trace()
-
-fig4, axs4 = plot.subplots(ncols=1, nrows=1, aspect=1.2, axwidth=3)
-
-axs4.plot(time_loop.index.values, time_loop['glacierArea'].values/1000000, linewidth=3, c='denim')
-
-axs4.format(
-#            abc=True, abcloc='ul',
-            ygridminor=True,
-            ytickloc='both', yticklabelloc='left',
-            xlabel='Date', ylabel='Glacier area (km$^{2}$)'
-            )
-
-fig4.savefig(os.path.join(plots_path, 'arvan_j2k_vs_GLACIOCLIM_MB.pdf'))
-#subprocess.Popen(os.path.join(plots_path, 'arvan_j2k_vs_GLACIOCLIM_MB.pdf'),shell=True)
-
-##########################################################
-
-fig5, axs5 = plot.subplots(ncols=1, nrows=2, aspect=2, axwidth=5, share=0)
-
-axs5[0].format(title='Daily temperature')
-axs5[0].plot(time_loop.index, time_loop['tmean_nc'], linewidth=1, c='darkred')
-axs5[0].set_ylabel('°C')
-axs5[1].format(title='Daily snowfall')
-axs5[1].plot(time_loop.index, time_loop['snow'], linewidth=1, c='skyblue')
-axs5[1].set_ylabel('mm')
-
-
-axs5.format(
-            abc=True, abcloc='ul',
-            ygridminor=True,
-            ytickloc='both', yticklabelloc='left',
-            xlabel='Date'
-            )
-
-fig5.savefig(os.path.join(plots_path, 'arvan_j2K_daily_meteo.pdf'))
-
-####################################################################################
-##########  PLOT J2K RUNOFF  ######################################################
-####################################################################################
-
-
-#j2k_seasonal_total_runoff = time_loop['catchmentSimRunoff'].groupby([lambda x: SeasonDict[x.month], time_loop.index.year]).mean()
-#j2k_seasonal_noGlacier_runoff = time_loop['noGlacierRunoff'].groupby([lambda x: SeasonDict[x.month], time_loop.index.year]).mean()
-#j2k_seasonal_glacier_runoff = time_loop['glacierRunoff'].groupby([lambda x: SeasonDict[x.month], time_loop.index.year]).mean()
-#j2k_seasonal_glacier_contribution = (j2k_seasonal_glacier_runoff/j2k_seasonal_total_runoff)*100
-#
-#j2K_daily_glacier_contribution = (time_loop['glacierRunoff']/time_loop['catchmentSimRunoff'])*100
-#j2K_monthly_glacier_contribution = j2K_daily_glacier_contribution.resample('M').mean()
-
-fig6, axs6 = plot.subplots(ncols=1, nrows=2, aspect=2, axwidth=4, spany=0)
-
-axs6.format(
-            abc=True, abcloc='ul',
-            ygridminor=True,
-            ytickloc='both', yticklabelloc='left',
-            xlabel='Date',
-#            suptitle="Glacier runoff contribution"
-            )
-
-#axs6[0].plot(j2K_daily_glacier_contribution.index, j2K_daily_glacier_contribution.values, linewidth=0.2, c='skyblue')
-#axs6[0].set_ylabel('Daily contribution (%)')
-#axs6[0].set_ylim(0, 15000)
-
-
-h1 = axs6[0].plot(j2K_monthly_ice_contribution.index, j2K_monthly_ice_contribution.values, c='skyblue', label='Net glacier contribution', legend='t')
-h2 = axs6[0].plot(j2K_monthly_glacier_contribution.index, j2K_monthly_glacier_contribution.values, c='denim', label='Total glacier contribution', legend='t')
-axs6[0].set_ylabel('Monthly contribution (%)')
-axs6[0].set_ylim(0, 100)
-
-#import pdb; pdb.set_trace()
-
-axs6[1].plot(j2k_annual_ice_contribution.index, j2k_annual_ice_contribution.values, color='skyblue')
-axs6[1].plot(j2k_annual_glacier_contribution.index, j2k_annual_glacier_contribution.values, color='denim')
-axs6[1].set_ylabel('Annual contribution (%)')
-axs6[1].set_ylim(0, 100)
-
-#fig6.legend(((h1,h2)), loc='t', ncols=2, frame=True)
-
-#fig6.savefig(os.path.join(plots_path, 'arvan_j2k_glacier_runoff_contribution.pdf'))
-#subprocess.Popen(os.path.join(plots_path, 'arvan_j2k_vs_obs_runoff.pdf'),shell=
-
-fig6.savefig(os.path.join(plots_path, 'arvan_j2K_glacier_runoff_contribution.pdf'))
-
-#########################################
-
-fig7, axs7 = plot.subplots(ncols=1, nrows=1, aspect=2, axwidth=4)
-
-axs7[0].plot(j2K_monthly_obs_runoff.index, j2K_monthly_obs_runoff.values, linewidth=2, c='black', label="Observations", legend='t')
-axs7[0].plot(j2K_monthly_noGlacier_runoff.index, j2K_monthly_noGlacier_runoff.values, linewidth=2, c='sienna', label="J2K without glacier", legend='t')
-axs7[0].plot(j2K_monthly_total_runoff.index, j2K_monthly_total_runoff.values, linewidth=2, c='denim', label="J2K with glacier", legend='t')
-
-#axs7[0].set_ylim(0, 15000)
-
-#axs7[1].plot(time_loop.index, time_loop['catchmentSimRunoff'].values - arvan_obs['runoff'].values, linewidth=0.1, c='darkred', label="J2K daily bias", legend='ur')
-##axs1[1].set_ylim(-10000, 10000)
-#
-#axs7[2].plot(time_loop.index, time_loop['catchmentSimRunoff'].values, linewidth=0.1, c='sienna', label="Observations", legend='ur')
-#axs7[2].plot(time_loop.index, time_loop['netGlacierRunoff'], linewidth=0.5, c='denim', label="J2K glacier runoff", legend='ur')
-##axs1[2].plot(time_loop.index, time_loop['rainRunoff'], linewidth=0.1, c='denim', label="J2K rain runoff", legend='ur')
-##axs1[2].plot(time_loop.index, time_loop['iceRunoff'], linewidth=0.1, c='denim', label="J2K ice runoff", legend='ur')
-
-axs7.format(
-#            abc=True, abcloc='ul',
-            yticklabelloc='left',
-            xlabel='Month', ylabel='Runoff (L/s)'
-            )
-
-fig1.savefig(os.path.join(plots_path, 'arvan_j2k_vs_obs_runoff.pdf'))
-#subprocess.Popen(os.path.join(plots_path, 'arvan_j2k_vs_obs_runoff.pdf'),shell=True)
+###############################################################################
+###                           FUNCTIONS                                     ###
+###############################################################################
 
+def read_time_loop(time_loop_path, cache_path=None):
+    # Parses the J2K TimeLoop.dat output in a single pass of the C parser, with float columns and the date as index
+    time_loop_stat = np.array([os.stat(time_loop_path).st_size, os.stat(time_loop_path).st_mtime_ns], dtype=np.int64)
+    if(cache_path is not None and os.path.isfile(cache_path)):
+        with np.load(cache_path, allow_pickle=False) as time_loop_cache:
+            if(np.array_equal(time_loop_cache['stat'], time_loop_stat)):
+                return pd.DataFrame(time_loop_cache['values'], columns=time_loop_cache['columns'], 
+                                    index=pd.DatetimeIndex(time_loop_cache['dates'], name=str(time_loop_cache['index_name'])))
+    
+    with open(time_loop_path, 'rb') as time_loop_file:
+        raw_time_loop = time_loop_file.read()
+    
+    # Start of each header line, of the data and of the closing line
+    line_starts = [0]
+    for line in range(time_loop_header_lines):
+        line_starts.append(raw_time_loop.index(b'\n', line_starts[-1]) + 1)
+    footer_start = raw_time_loop.rstrip(b'\r\n').rfind(b'\n') + 1
+    
+    # The last column is not used
+    columns = raw_time_loop[line_starts[5]:line_starts[6]].decode().rstrip('\r\n').split('\t')
+    columns = columns[:-1]
+    
+    # The values are parsed to the nearest double (round_trip), as the fast C parser may be off by one unit in the last place
+    time_loop = pd.read_csv(io.BytesIO(raw_time_loop[line_starts[-1]:footer_start]), sep="\t", header=None, names=columns, usecols=range(0, len(columns)), 
+                            index_col=0, dtype=dict.fromkeys(columns[1:], np.float64), engine='c', float_precision='round_trip')
+    try:
+        time_loop.index = pd.to_datetime(time_loop.index, format=time_loop_date_format)
+    except ValueError:
+        time_loop.index = pd.to_datetime(time_loop.index)
+    
+    if(cache_path is not None):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_cache_path = cache_path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_cache_path, stat=time_loop_stat, values=time_loop.values, columns=np.asarray(time_loop.columns, dtype=str), 
+                 dates=time_loop.index.values, index_name=str(time_loop.index.name))
+        os.replace(tmp_cache_path, cache_path)
+    
+    return time_loop
+
+def get_time_codes(dates):
+    # Integer season, year and month codes of each day, computed once for all the aggregations
+    month_season_codes = np.array([0] + [season_names.index(SeasonDict[month]) for month in range(1, 13)])
+    return {'season': month_season_codes[dates.month.values], 'year': dates.year.values, 'month': dates.month.values}
+
+def aggregate_time_loop(time_loop, aggregations, time_codes=None):
+    # Grouped reductions of the TimeLoop variables, one per resolution and statistic for all the variables at once.
+    # Returns a dataframe per resolution with (variable, statistic) columns
+    if(time_codes is None):
+        time_codes = get_time_codes(time_loop.index)
+    resolution_keys = {'seasonal': [time_codes['season'], time_codes['year']], 'annual': [time_codes['year']], 'monthly': [time_codes['month']]}
+    
+    aggregates = {}
+    for resolution, variable_statistics in aggregations.items():
+        grouped_time_loop = time_loop[list(variable_statistics)].groupby(resolution_keys[resolution])
+        statistics = sorted(set(statistic for variable in variable_statistics for statistic in variable_statistics[variable]))
+        aggregate = pd.concat([grouped_time_loop[[variable for variable in variable_statistics if statistic in variable_statistics[variable]]].agg(statistic) for statistic in statistics], 
+                              axis=1, keys=statistics).swaplevel(axis=1)
+        if(resolution == 'seasonal'):
+            aggregate = aggregate.rename(index=dict(enumerate(season_names)), level=0)
+        aggregates[resolution] = aggregate
+    
+    return aggregates
+
+
+def read_arvan_obs(arvan_obs_path):
+    # Open and parse Arvan hydrological observations
+    arvan_obs = pd.read_csv(os.path.join(arvan_obs_path, "W1055020_qj_hydro2.txt"), sep=";", skiprows=range(0,3), skipfooter=1, 
+                            names=['freq', 'ID', 'date', 'runoff', 'mode', 'confidence'], index_col=2, usecols=range(0,6))
+    
+    arvan_obs.index =  pd.to_datetime(arvan_obs.index, format='%Y%m%d')
+    
+    ### Fill empty dates with nan
+    
+    idx = pd.date_range(arvan_obs.index[0], arvan_obs.index[-1])
+    
+    arvan_obs.index = pd.DatetimeIndex(arvan_obs.index)
+    
+    arvan_obs = arvan_obs.reindex(idx, fill_value=np.nan)
+    
+    return arvan_obs
+
+def read_sorlin_seasonal_mb(smb_path):
+    # We load the season MB data for Saint Sorlin glacier
+    sorlin_seasonal_mb = pd.read_csv(os.path.join(smb_path, "st_sorlin_seasonal_mb.csv"), sep=";")
+    
+    sorlin_seasonal_mb['summer L'] = sorlin_seasonal_mb['Summer']*sorlin_seasonal_mb['Surface (m2)']*1000
+    sorlin_seasonal_mb['winter L'] = sorlin_seasonal_mb['Winter']*sorlin_seasonal_mb['Surface (m2)']*1000
+    
+    sorlin_seasonal_mb['annual L'] = sorlin_seasonal_mb['Annual']*sorlin_seasonal_mb['Surface (m2)']*1000
+    
+    return sorlin_seasonal_mb
+
+def process_j2k_run(j2k_output_path, arvan_obs, cache_path=None):
+    # Runoff, mass balance and glacier contribution series of a J2K run and its performance against the observations
+    
+    # Read TimeLoop J2K output
+    time_loop = read_time_loop(os.path.join(j2k_output_path, 'TimeLoop.dat'), cache_path)
+    
+    # We crop both dataframes for the same period
+    time_loop = time_loop.loc[arvan_obs.index[0]:arvan_obs.index[-1]]
+    arvan_obs = arvan_obs.loc[arvan_obs.index[0]:time_loop.index[-1]]
+    
+    # Convert sim runoff to L/s
+    time_loop['catchmentSimRunoff'] = time_loop['catchmentSimRunoff']/86400
+    time_loop['glacierRunoff'] = time_loop['glacierRunoff']/86400
+    time_loop['iceRunoff'] = time_loop['iceRunoff']/86400
+    time_loop['rainRunoff'] = time_loop['rainRunoff']/86400
+    
+    # Choose subset of dates for plots
+    time_loop = time_loop.loc[time_loop.index > '2000-10-01'][1:]
+    arvan_obs = arvan_obs.loc[arvan_obs.index > '2000-10-01']
+    
+    # De-accumulate massBalance and convert it to seasonal and annual series
+    #j2k_mb_non_cumulative = time_loop['massBalance'].diff()
+    
+    time_loop['MB_nc'] = time_loop['massBalance']
+    #time_loop['MB_nc'] = j2k_mb_non_cumulative
+    #time_loop['MB_nc'] = time_loop['MB_nc'].interpolate()
+    
+    # De-accumulate temperature
+    #j2k_tmean_non_cumulative = time_loop['tmean_glacier'].diff()
+    time_loop['tmean_nc'] = time_loop['tmean_glacier']
+    
+    #time_loop['tmean_nc'] = j2k_tmean_non_cumulative
+    #time_loop['tmean_nc'] = time_loop['tmean_nc'].interpolate()
+    
+    time_loop['noGlacierRunoff'] = time_loop['catchmentSimRunoff'] - time_loop['glacierRunoff']
+    time_loop['netGlacierRunoff'] = time_loop['glacierRunoff'] - time_loop['rainRunoff']
+    
+    # Seasonal, annual and monthly statistics of all the variables
+    time_codes = get_time_codes(time_loop.index)
+    j2k_aggregates = aggregate_time_loop(time_loop, time_loop_aggregations, time_codes)
+    j2k_seasonal, j2k_annual, j2k_monthly = j2k_aggregates['seasonal'], j2k_aggregates['annual'], j2k_aggregates['monthly']
+    j2k_annual = j2k_annual.loc[j2k_annual.index > 2000]
+    
+    j2k_run = {'time_loop': time_loop, 'arvan_obs': arvan_obs}
+    
+    j2k_run['j2k_seasonal_MB'] = j2k_seasonal['MB_nc', 'sum']
+    j2k_run['j2k_annual_MB'] = j2k_annual['MB_nc', 'sum']
+    
+    # Calculate seasonal snow and mean temperature
+    j2k_run['j2k_seasonal_snow'] = j2k_seasonal['netSnow_glacier', 'sum']
+    j2k_run['j2k_seasonal_rain'] = j2k_seasonal['netRain_glacier', 'sum']
+    j2k_run['j2k_seasonal_meanTemp'] = j2k_seasonal['tmean_nc', 'mean']
+    
+    j2k_run['j2k_annual_snow'] = j2k_annual['netSnow_glacier', 'sum']
+    j2k_run['j2k_annual_rain'] = j2k_annual['netRain_glacier', 'sum']
+    j2k_run['j2k_annual_meanTemp'] = j2k_annual['tmean_nc', 'mean']
+    
+    ##### SEASONAL RUNOFF COMPUTATION  #####
+    
+    j2k_run['j2k_seasonal_total_runoff'] = j2k_seasonal['catchmentSimRunoff', 'mean']
+    j2k_run['j2k_seasonal_noGlacier_runoff'] = j2k_seasonal['noGlacierRunoff', 'mean']
+    j2k_run['j2k_seasonal_glacier_runoff'] = j2k_seasonal['iceRunoff', 'mean']
+    j2k_run['j2k_seasonal_glacier_contribution'] = (j2k_run['j2k_seasonal_glacier_runoff']/j2k_run['j2k_seasonal_total_runoff'])*100
+    
+    j2k_run['j2K_monthly_obs_runoff'] = arvan_obs['runoff'].groupby(time_codes['month']).mean()
+    j2k_run['j2K_monthly_total_runoff'] = j2k_monthly['catchmentSimRunoff', 'mean']
+    j2k_run['j2K_monthly_noGlacier_runoff'] = j2k_monthly['noGlacierRunoff', 'mean']
+    
+    j2K_daily_ice_contribution = (time_loop['iceRunoff']/time_loop['catchmentSimRunoff'])*100
+    j2k_run['j2K_monthly_ice_contribution'] = j2K_daily_ice_contribution.resample('M').mean()
+    j2k_run['j2k_annual_ice_contribution'] = j2K_daily_ice_contribution.resample('Y').mean()
+    
+    j2K_daily_glacier_contribution = (time_loop['glacierRunoff']/time_loop['catchmentSimRunoff'])*100
+    j2k_run['j2K_monthly_glacier_contribution'] = j2K_daily_glacier_contribution.resample('M').mean()
+    j2k_run['j2k_annual_glacier_contribution'] = j2K_daily_glacier_contribution.resample('Y').mean()
+    
+    #############  COMPUTE J2K PERFORMANCE  ##############
+    
+    # Both runoff series are evaluated at once, for the whole period and each season
+    j2k_runoff = np.vstack((time_loop['catchmentSimRunoff'].values, time_loop['noGlacierRunoff'].values))
+    j2k_run['j2k_metrics'] = evaluate_seasons(j2k_runoff, arvan_obs['runoff'].values, time_loop.index, SeasonDict)
+    
+    return j2k_run
+
+def summarize_j2k_run(j2k_run, sorlin_seasonal_mb, run):
+    # Tidy rows (run, variable, period, statistic, value) with the runoff metrics, the annual and summer mass balance
+    # against GLACIOCLIM and the mean glacier runoff contributions of a J2K run
+    summary = []
+    for period, period_metrics in j2k_run['j2k_metrics'].items():
+        for series_idx, variable in enumerate(['catchmentSimRunoff', 'noGlacierRunoff']):
+            for statistic, values in period_metrics.items():
+                summary.append((run, variable, period, statistic, float(values[series_idx])))
+    
+    # Glacier-wide mass balance of the GLACIOCLIM years
+    mb_years = sorlin_seasonal_mb['Year'].values
+    j2k_mb = np.vstack((j2k_run['j2k_annual_MB'].reindex(mb_years).values, j2k_run['j2k_seasonal_MB']['Summer'].reindex(mb_years).values))
+    for series_idx, (period, glacioclim_mb) in enumerate([('annual', sorlin_seasonal_mb['annual L'].values), ('Summer', sorlin_seasonal_mb['summer L'].values)]):
+        # Only the GLACIOCLIM years simulated by the run are compared
+        mb_metrics = evaluate_runs(j2k_mb[series_idx], glacioclim_mb, ~np.isnan(j2k_mb[series_idx]))
+        for statistic in ['r', 'rmse', 'bias']:
+            summary.append((run, 'MB_nc', period, statistic, float(mb_metrics[statistic][0])))
+        summary.append((run, 'MB_nc', period, 'n_years', float(mb_metrics['n_days'][0])))
+        summary.append((run, 'MB_nc', period, 'mean', float(np.nanmean(j2k_mb[series_idx]))))
+    
+    summary.append((run, 'iceContribution', 'annual', 'mean', float(j2k_run['j2k_annual_ice_contribution'].mean())))
+    summary.append((run, 'glacierContribution', 'annual', 'mean', float(j2k_run['j2k_annual_glacier_contribution'].mean())))
+    
+    return summary
+
+def init_ensemble_worker(i_arvan_obs, i_sorlin_seasonal_mb, plot_runs=False):
+    # Observations are sent once to each worker and shared by all its runs
+    global ensemble_state
+    ensemble_state = {'arvan_obs': i_arvan_obs, 'sorlin_seasonal_mb': i_sorlin_seasonal_mb, 'plot_runs': plot_runs}
+
+def compute_ensemble_run(j2k_output_path):
+    j2k_run = process_j2k_run(j2k_output_path, ensemble_state['arvan_obs'], os.path.join(j2k_output_path, 'TimeLoop_cache.npz'))
+    
+    # The figures of each run are rendered headless in its own output folder
+    if(ensemble_state['plot_runs']):
+        render_figures(get_figures(j2k_run, ensemble_state['sorlin_seasonal_mb']), os.path.join(j2k_output_path, 'plots'))
+    
+    return summarize_j2k_run(j2k_run, ensemble_state['sorlin_seasonal_mb'], j2k_output_path)
+
+def get_ensemble_paths(j2k_output_patterns):
+    # J2K output folders with a TimeLoop.dat file matching any of the paths or glob patterns
+    j2k_output_paths = set()
+    for j2k_output_pattern in j2k_output_patterns:
+        j2k_output_paths.update(path for path in glob.glob(j2k_output_pattern) if os.path.isfile(os.path.join(path, 'TimeLoop.dat')))
+    
+    return sorted(j2k_output_paths)
+
+def run_ensemble(j2k_output_paths, arvan_obs, sorlin_seasonal_mb, i_n_workers=1, plot_runs=False):
+    # Summary table of all the J2K runs, processed across a process pool if i_n_workers > 1
+    print("\nJ2K runs: " + str(len(j2k_output_paths)))
+    if(i_n_workers > 1 and len(j2k_output_paths) > 1):
+        with multiprocessing.Pool(min(i_n_workers, len(j2k_output_paths)), initializer=init_ensemble_worker, initargs=(arvan_obs, sorlin_seasonal_mb, plot_runs)) as pool:
+            run_summaries = pool.map(compute_ensemble_run, j2k_output_paths)
+    else:
+        init_ensemble_worker(arvan_obs, sorlin_seasonal_mb, plot_runs)
+        run_summaries = [compute_ensemble_run(j2k_output_path) for j2k_output_path in j2k_output_paths]
+    
+    return pd.DataFrame([row for run_summary in run_summaries for row in run_summary], columns=['run', 'variable', 'period', 'statistic', 'value'])
+
+def load_plotting(headless=False):
+    # Lazy import of matplotlib and proplot, on the Agg backend for headless rendering
+    global plt, plot
+    if(plot is None):
+        import matplotlib
+        if(headless):
+            matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        import proplot as plot
+
+# PLOT J2K VS OBS RUNOFF
+def plot_j2k_vs_obs_runoff(time_loop, arvan_obs):
+    fig1, axs1 = plot.subplots(ncols=1, nrows=3, aspect=3, axwidth=6)
+    
+    axs1[0].plot(time_loop.index, arvan_obs['runoff'], linewidth=0.1, c='black', label="Observations", legend='ur')
+    axs1[0].plot(time_loop.index, time_loop['catchmentSimRunoff'], linewidth=0.1, c='sienna', label="J2K", legend='ur')
+    #axs1[0].set_ylim(0, 15000)
+    
+    axs1[1].plot(time_loop.index, time_loop['catchmentSimRunoff'].values - arvan_obs['runoff'].values, linewidth=0.1, c='darkred', label="J2K daily bias", legend='ur')
+    #axs1[1].set_ylim(-10000, 10000)
+    
+    axs1[2].plot(time_loop.index, time_loop['catchmentSimRunoff'].values, linewidth=0.1, c='sienna', label="Observations", legend='ur')
+    axs1[2].plot(time_loop.index, time_loop['iceRunoff'], linewidth=0.5, c='denim', label="J2K glacier runoff", legend='ur')
+    #axs1[2].plot(time_loop.index, time_loop['rainRunoff'], linewidth=0.1, c='denim', label="J2K rain runoff", legend='ur')
+    #axs1[2].plot(time_loop.index, time_loop['iceRunoff'], linewidth=0.1, c='denim', label="J2K ice runoff", legend='ur')
+    
+    axs1.format(
+                abc=True, abcloc='ul',
+                ygridminor=True,
+                ytickloc='both', yticklabelloc='left',
+                xlabel='Date', ylabel='Runoff (L/s)'
+                )
+    
+    return fig1
+
+# PLOT DAILY MASS BALANCE
+def plot_runoff_mb_climate(time_loop, j2k_annual_MB, j2k_seasonal_MB, j2k_annual_meanTemp, j2k_seasonal_meanTemp, j2k_annual_snow, j2k_seasonal_snow):
+    fig2, axs2 = plot.subplots(ncols=1, nrows=4, axwidth=2, aspect=2, share=1)
+    
+    axs2[0].plot(time_loop.index, np.cumsum(time_loop['massBalance'].values), linewidth=1, c='steelblue')
+    axs2[0].set_ylabel('m.w.e.')
+    axs2[0].format(title='Cumulative daily MB')
+    axs2[1].plot(j2k_annual_MB.index, j2k_seasonal_MB['Winter'][1:] + j2k_seasonal_MB['Summer'], linewidth=1, c='steelblue')
+    axs2[1].set_ylabel('m.w.e. d$^{-1}$')
+    axs2[1].axhline(y=0, color='black', linewidth=0.7, linestyle='-')
+    axs2[1].format(title='Annual MB')
+    axs2[2].plot(j2k_annual_meanTemp.index.values[1:-1], j2k_seasonal_meanTemp['Winter'][2:-1] + j2k_seasonal_meanTemp['Summer'].values[1:-1], linewidth=1, c='darkred')
+    axs2[2].set_ylabel('°C')
+    axs2[2].format(title='Annual mean temperature')
+    axs2[3].plot(j2k_annual_snow.index.values[1:-1], j2k_seasonal_snow['Winter'][2:-1] + j2k_seasonal_snow['Summer'][1:-1], linewidth=1, c='skyblue')
+    axs2[3].set_ylabel('mm')
+    axs2[3].format(title='Annual snowfall')
+    
+    axs2.format(
+    #            abc=True, abcloc='ul',
+                ygridminor=True,
+                ytickloc='both', yticklabelloc='left',
+                xlabel='Date'
+                )
+    
+    return fig2
+
+# PLOT SEASONAL MASS BALANCE VALIDATION
+def plot_seasonal_mb(sorlin_seasonal_mb, j2k_annual_MB, j2k_seasonal_MB, j2k_seasonal_snow, j2k_seasonal_rain, j2k_annual_meanTemp, j2k_seasonal_meanTemp):
+    fig3, axs3 = plot.subplots([[1, 1],[2, 3],[4, 5],[6, 7],[8, 9]], ncols=2, nrows=5, aspect=4, axwidth=4, spany=0)
+    
+    axs3[0].format(title='Annual glacier-wide MB')
+    axs3[0].set_ylabel('L')
+    axs3[0].axhline(y=0, color='black', linewidth=0.7, linestyle='-')
+    h5 = axs3[0].plot(sorlin_seasonal_mb['Year'].values, sorlin_seasonal_mb['annual L'].values, linewidth=3, c='black', label="GLACIOCLIM annual MB")
+    h6 = axs3[0].plot(j2k_annual_MB.index.values[1:-1], j2k_annual_MB.values[1:-1], linewidth=3, c='olive', label="J2K annual MB")
+    
+    axs3[1].axhline(y=0, color='black', linewidth=0.7, linestyle='-')
+    axs3[1].format(title='Winter MB')
+    axs3[1].set_ylabel('L')
+    h1 = axs3[1].plot(sorlin_seasonal_mb['Year'].values[1:-1], sorlin_seasonal_mb['winter L'].values[1:-1], linewidth=3, c='darkblue', label="GLACIOCLIM winter MB")
+    h2 = axs3[1].plot(j2k_seasonal_MB['Winter'].index.values[1:-1], j2k_seasonal_MB['Winter'].values[1:-1], linewidth=3, c='skyblue', label="J2K winter MB")
+    axs3[3].format(title='Winter snowfall')
+    axs3[3].set_ylabel('mm')
+    axs3[3].plot(j2k_annual_MB.index.values[:-1], j2k_seasonal_snow['Winter'].values[1:-1], linewidth=2, c='skyblue')
+    axs3[5].format(title='Winter rainfall')
+    axs3[5].set_ylabel('mm')
+    axs3[5].plot(j2k_annual_MB.index.values[:-1], j2k_seasonal_rain['Winter'].values[1:-1], linewidth=2, c='steelblue')
+    axs3[7].format(title='Winter mean temperature')
+    axs3[7].set_ylabel('°C')
+    axs3[7].axhline(y=0, color='black', linewidth=0.7, linestyle='-')
+    axs3[7].plot(j2k_annual_meanTemp.index.values[:-1], j2k_seasonal_meanTemp['Winter'].values[1:-1], linewidth=2, c='crimson')
+    
+    axs3[2].axhline(y=0, color='black', linewidth=0.7, linestyle='-')
+    axs3[2].format(title='Summer MB')
+    axs3[2].set_ylabel('L')
+    h3 = axs3[2].plot(sorlin_seasonal_mb['Year'].values[1:-1], sorlin_seasonal_mb['summer L'].values[1:-1], linewidth=3, c='darkred', label="GLACIOCLIM summer MB")
+    h4 = axs3[2].plot(j2k_seasonal_MB['Summer'].index.values[:-1], j2k_seasonal_MB['Summer'].values[:-1], linewidth=3, c='sienna', label="J2K summer MB")
+    axs3[4].format(title='Summer snowfall')
+    axs3[4].set_ylabel('mm')
+    axs3[4].plot(j2k_annual_MB.index.values[:-1], j2k_seasonal_snow['Summer'].values[:-1], linewidth=2, c='skyblue')
+    axs3[6].format(title='Summer rainfall')
+    axs3[6].set_ylabel('mm')
+    axs3[6].plot(j2k_annual_MB.index.values[:-1], j2k_seasonal_rain['Summer'].values[:-1], linewidth=2, c='steelblue')
+    axs3[8].format(title='Summer mean temperature')
+    axs3[8].set_ylabel('°C')
+    axs3[8].axhline(y=0, color='black', linewidth=0.7, linestyle='-')
+    axs3[8].plot(j2k_annual_meanTemp.index.values[:-1], j2k_seasonal_meanTemp['Summer'].values[:-1], linewidth=2, c='crimson')
+    
+    fig3.legend(((h5,h6,h1,h2,h3,h4)), loc='r', ncols=1, frame=True)
+    
+    axs3.format(
+                abc=True, abcloc='ur',
+                ygridminor=True,
+                ytickloc='both', yticklabelloc='left',
+                xlabel='Year'
+                )
+    
+    return fig3
+
+# PLOT GLACIER AREA
+def plot_glacier_area(time_loop):
+    fig4, axs4 = plot.subplots(ncols=1, nrows=1, aspect=1.2, axwidth=3)
+    
+    axs4.plot(time_loop.index.values, time_loop['glacierArea'].values/1000000, linewidth=3, c='denim')
+    
+    axs4.format(
+    #            abc=True, abcloc='ul',
+                ygridminor=True,
+                ytickloc='both', yticklabelloc='left',
+                xlabel='Date', ylabel='Glacier area (km$^{2}$)'
+                )
+    
+    return fig4
+
+# PLOT DAILY METEO
+def plot_daily_meteo(time_loop):
+    fig5, axs5 = plot.subplots(ncols=1, nrows=2, aspect=2, axwidth=5, share=0)
+    
+    axs5[0].format(title='Daily temperature')
+    axs5[0].plot(time_loop.index, time_loop['tmean_nc'], linewidth=1, c='darkred')
+    axs5[0].set_ylabel('°C')
+    axs5[1].format(title='Daily snowfall')
+    axs5[1].plot(time_loop.index, time_loop['snow'], linewidth=1, c='skyblue')
+    axs5[1].set_ylabel('mm')
+    
+    
+    axs5.format(
+                abc=True, abcloc='ul',
+                ygridminor=True,
+                ytickloc='both', yticklabelloc='left',
+                xlabel='Date'
+                )
+    
+    return fig5
+
+# PLOT J2K GLACIER RUNOFF CONTRIBUTION
+def plot_glacier_runoff_contribution(j2K_monthly_ice_contribution, j2K_monthly_glacier_contribution, j2k_annual_ice_contribution, j2k_annual_glacier_contribution):
+    fig6, axs6 = plot.subplots(ncols=1, nrows=2, aspect=2, axwidth=4, spany=0)
+    
+    axs6.format(
+                abc=True, abcloc='ul',
+                ygridminor=True,
+                ytickloc='both', yticklabelloc='left',
+                xlabel='Date',
+    #            suptitle="Glacier runoff contribution"
+                )
+    
+    #axs6[0].plot(j2K_daily_glacier_contribution.index, j2K_daily_glacier_contribution.values, linewidth=0.2, c='skyblue')
+    #axs6[0].set_ylabel('Daily contribution (%)')
+    #axs6[0].set_ylim(0, 15000)
+    
+    
+    h1 = axs6[0].plot(j2K_monthly_ice_contribution.index, j2K_monthly_ice_contribution.values, c='skyblue', label='Net glacier contribution', legend='t')
+    h2 = axs6[0].plot(j2K_monthly_glacier_contribution.index, j2K_monthly_glacier_contribution.values, c='denim', label='Total glacier contribution', legend='t')
+    axs6[0].set_ylabel('Monthly contribution (%)')
+    axs6[0].set_ylim(0, 100)
+    
+    #import pdb; pdb.set_trace()
+    
+    axs6[1].plot(j2k_annual_ice_contribution.index, j2k_annual_ice_contribution.values, color='skyblue')
+    axs6[1].plot(j2k_annual_glacier_contribution.index, j2k_annual_glacier_contribution.values, color='denim')
+    axs6[1].set_ylabel('Annual contribution (%)')
+    axs6[1].set_ylim(0, 100)
+    
+    #fig6.legend(((h1,h2)), loc='t', ncols=2, frame=True)
+    
+    return fig6
+
+# PLOT MONTHLY RUNOFF
+def plot_monthly_runoff(j2K_monthly_obs_runoff, j2K_monthly_noGlacier_runoff, j2K_monthly_total_runoff):
+    fig7, axs7 = plot.subplots(ncols=1, nrows=1, aspect=2, axwidth=4)
+    
+    axs7[0].plot(j2K_monthly_obs_runoff.index, j2K_monthly_obs_runoff.values, linewidth=2, c='black', label="Observations", legend='t')
+    axs7[0].plot(j2K_monthly_noGlacier_runoff.index, j2K_monthly_noGlacier_runoff.values, linewidth=2, c='sienna', label="J2K without glacier", legend='t')
+    axs7[0].plot(j2K_monthly_total_runoff.index, j2K_monthly_total_runoff.values, linewidth=2, c='denim', label="J2K with glacier", legend='t')
+    
+    #axs7[0].set_ylim(0, 15000)
+    
+    #axs7[1].plot(time_loop.index, time_loop['catchmentSimRunoff'].values - arvan_obs['runoff'].values, linewidth=0.1, c='darkred', label="J2K daily bias", legend='ur')
+    ##axs1[1].set_ylim(-10000, 10000)
+    #
+    #axs7[2].plot(time_loop.index, time_loop['catchmentSimRunoff'].values, linewidth=0.1, c='sienna', label="Observations", legend='ur')
+    #axs7[2].plot(time_loop.index, time_loop['netGlacierRunoff'], linewidth=0.5, c='denim', label="J2K glacier runoff", legend='ur')
+    ##axs1[2].plot(time_loop.index, time_loop['rainRunoff'], linewidth=0.1, c='denim', label="J2K rain runoff", legend='ur')
+    ##axs1[2].plot(time_loop.index, time_loop['iceRunoff'], linewidth=0.1, c='denim', label="J2K ice runoff", legend='ur')
+    
+    axs7.format(
+    #            abc=True, abcloc='ul',
+                yticklabelloc='left',
+                xlabel='Month', ylabel='Runoff (L/s)'
+                )
+    
+    return fig7
+
+def get_figures(j2k_run, sorlin_seasonal_mb):
+    # PDF file, plotting function and input series of each figure
+    time_loop, arvan_obs = j2k_run['time_loop'], j2k_run['arvan_obs']
+    
+    return [('arvan_j2k_vs_obs_runoff.pdf', plot_j2k_vs_obs_runoff, {'time_loop': time_loop[['catchmentSimRunoff', 'iceRunoff']], 'arvan_obs': arvan_obs[['runoff']]}),
+            ('arvan_runoff_mb_climate.pdf', plot_runoff_mb_climate, {'time_loop': time_loop[['massBalance']], 
+                                                                     **{key: j2k_run[key] for key in ['j2k_annual_MB', 'j2k_seasonal_MB', 'j2k_annual_meanTemp', 'j2k_seasonal_meanTemp', 'j2k_annual_snow', 'j2k_seasonal_snow']}}),
+            ('seasonal_mb.pdf', plot_seasonal_mb, {'sorlin_seasonal_mb': sorlin_seasonal_mb, 
+                                                   **{key: j2k_run[key] for key in ['j2k_annual_MB', 'j2k_seasonal_MB', 'j2k_seasonal_snow', 'j2k_seasonal_rain', 'j2k_annual_meanTemp', 'j2k_seasonal_meanTemp']}}),
+            ('arvan_j2k_vs_GLACIOCLIM_MB.pdf', plot_glacier_area, {'time_loop': time_loop[['glacierArea']]}),
+            ('arvan_j2K_daily_meteo.pdf', plot_daily_meteo, {'time_loop': time_loop[['tmean_nc', 'snow']]}),
+            ('arvan_j2K_glacier_runoff_contribution.pdf', plot_glacier_runoff_contribution, 
+             {key: j2k_run[key] for key in ['j2K_monthly_ice_contribution', 'j2K_monthly_glacier_contribution', 'j2k_annual_ice_contribution', 'j2k_annual_glacier_contribution']}),
+            ('arvan_j2k_vs_obs_monthly_runoff.pdf', plot_monthly_runoff, {key: j2k_run[key] for key in ['j2K_monthly_obs_runoff', 'j2K_monthly_noGlacier_runoff', 'j2K_monthly_total_runoff']})]
+
+def hash_figure(plot_function, inputs):
+    # Content hash of the plotting code and the input series of a figure
+    figure_hash = hashlib.sha256(inspect.getsource(plot_function).encode())
+    for name in sorted(inputs):
+        figure_hash.update(name.encode())
+        if(isinstance(inputs[name], pd.DataFrame)):
+            figure_hash.update(str(list(inputs[name].columns)).encode())
+        figure_hash.update(pd.util.hash_pandas_object(inputs[name]).values.tobytes())
+    
+    return figure_hash.hexdigest()
+
+def render_figure(figure):
+    pdf_name, plot_function, inputs, figure_plots_path = figure
+    load_plotting(headless=True)
+    fig = plot_function(**inputs)
+    fig.savefig(os.path.join(figure_plots_path, pdf_name))
+    plt.close(fig)
+    
+    return pdf_name
+
+def render_figures(figures, figure_plots_path, i_n_workers=1):
+    # Headless rendering of the figures whose inputs changed since their PDF was written, across a process pool if i_n_workers > 1
+    os.makedirs(figure_plots_path, exist_ok=True)
+    figure_hashes_path = os.path.join(figure_plots_path, figure_hashes_file)
+    figure_hashes = {}
+    if(os.path.isfile(figure_hashes_path)):
+        with open(figure_hashes_path) as figure_hashes_json:
+            figure_hashes = json.load(figure_hashes_json)
+    
+    current_hashes = {pdf_name: hash_figure(plot_function, inputs) for pdf_name, plot_function, inputs in figures}
+    pending_figures = [(pdf_name, plot_function, inputs, figure_plots_path) for pdf_name, plot_function, inputs in figures 
+                       if figure_hashes.get(pdf_name) != current_hashes[pdf_name] or not os.path.isfile(os.path.join(figure_plots_path, pdf_name))]
+    print("\nFigures rendered: " + str(len(pending_figures)) + " / " + str(len(figures)))
+    
+    # Daemonic processes (e.g. ensemble workers) cannot start their own pool
+    if(i_n_workers > 1 and len(pending_figures) > 1 and not multiprocessing.current_process().daemon):
+        with multiprocessing.Pool(min(i_n_workers, len(pending_figures))) as pool:
+            rendered_figures = pool.map(render_figure, pending_figures)
+    else:
+        rendered_figures = [render_figure(figure) for figure in pending_figures]
+    
+    figure_hashes.update({pdf_name: current_hashes[pdf_name] for pdf_name in rendered_figures})
+    with open(figure_hashes_path + '.tmp', 'w') as figure_hashes_json:
+        json.dump(figure_hashes, figure_hashes_json, indent=2)
+    os.replace(figure_hashes_path + '.tmp', figure_hashes_path)
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Plots and performance of ALPGM-J2K simulations of the Arvan catchment')
+    parser.add_argument('--ensemble', nargs='+', metavar='J2K_OUTPUT', help='J2K output folders or glob patterns to summarize in a single table')
+    parser.add_argument('--n-workers', type=int, default=n_workers)
+    parser.add_argument('--summary-path', default=ensemble_summary_path)
+    parser.add_argument('--headless', action='store_true', help='render the figures in parallel on the Agg backend, skipping unchanged ones, without showing them')
+    parser.add_argument('--plot-runs', action='store_true', help='render the figures of each ensemble run in its plots subfolder')
+    
+    return parser.parse_args(argv)
 
-########################################
 
-plt.show()
+###############################################################################
+###                           MAIN                                          ###
+###############################################################################
 
+if __name__ == '__main__':
+    
+    args = parse_arguments()
+    
+    arvan_obs = read_arvan_obs(arvan_obs_path)
+    sorlin_seasonal_mb = read_sorlin_seasonal_mb(smb_path)
+    
+    if(args.ensemble):
+        ensemble_summary = run_ensemble(get_ensemble_paths(args.ensemble), arvan_obs, sorlin_seasonal_mb, args.n_workers, args.plot_runs)
+        os.makedirs(os.path.dirname(args.summary_path), exist_ok=True)
+        ensemble_summary.to_csv(args.summary_path, index=False)
+        print("\nEnsemble summary saved in " + args.summary_path)
+        sys.exit()
+    
+    j2k_run = process_j2k_run(j2k_output_path, arvan_obs, time_loop_cache_path)
+    
+    j2k_metrics = j2k_run['j2k_metrics']
+    
+    ### Kling-Gupta Efficiency (objective function 1)
+    kge_j2k, kge_j2k_no_glacier = j2k_metrics['all']['kge']
+    
+    # Nash-Sutcliffe Efficiency (nse)
+    nse_j2k, nse_j2k_no_glacier = j2k_metrics['all']['nse']
+    
+    print("\nJ2K KGE with glacier: " + str(kge_j2k))
+    print("\nJ2K NSE with glacier: " + str(nse_j2k))
+    
+    print("\nJ2K KGE without glacier: " + str(kge_j2k_no_glacier))
+    print("\nJ2K NSE without glacier: " + str(nse_j2k_no_glacier))
+    
+    for season in season_names:
+        print("\nJ2K " + season + " KGE with glacier: " + str(j2k_metrics[season]['kge'][0]) + " / without glacier: " + str(j2k_metrics[season]['kge'][1]))
+    
+    #import pdb; pdb.set_trace()
+    
+    figures = get_figures(j2k_run, sorlin_seasonal_mb)
+    if(args.headless):
+        render_figures(figures, plots_path, args.n_workers)
+    else:
+        load_plotting()
+        for pdf_name, plot_function, inputs in figures:
+            plot_function(**inputs).savefig(os.path.join(plots_path, pdf_name))
+        
+        plt.show()
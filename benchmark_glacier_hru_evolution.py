@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""
+@author: Jordi Bolibar
+Institut des Géosciences de l'Environnement (Université Grenoble Alpes)
+jordi.bolibar@univ-grenoble-alpes.fr
+
+BENCHMARK OF THE DYNAMIC GLACIERIZED PERCENTAGE PER HRU COMPUTATION
+SYNTHETIC CATCHMENTS AND GOLDEN OUTPUT CHECK ON THE ARVAN DATA
+
+"""
+
+## Dependencies: ##
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import subprocess
+import tempfile
+import numpy as np
+import pandas as pd
+try:
+    from osgeo import gdal
+except:
+    import gdal
+
+import glacier_hru_evolution as ghe
+
+######   FILE PATHS    #######
+workspace = os.path.dirname(os.path.abspath(__file__))
+arvan_hru_path = os.path.join(workspace, 'HRUs')
+arvan_glacier_thickness_path = os.path.join(workspace, 'glacier_thickness', 'original_glacier_thickness')
+golden_output_path = os.path.join(workspace, 'HRU_glacier_fractions', 'HRU_glacier_fractions_2003_2015.dat')
+
+# Options of the glacier_hru_evolution runs benchmarked and checked against the golden output
+variants = {'serial': {'n_workers': 1},
+            'n_workers': {'n_workers': 4},
+            'tiled': {'n_workers': 1, 'tiled': True},
+            'streaming': {'n_workers': 1, 'streaming': True}}
+
+
+###############################################################################
+###                           FUNCTIONS                                     ###
+###############################################################################
+
+def write_raster(raster_path, data, geo_transform, data_type):
+    raster = gdal.GetDriverByName('GTiff').Create(raster_path, data.shape[1], data.shape[0], 1, data_type)
+    raster.SetGeoTransform(geo_transform)
+    raster.GetRasterBand(1).WriteArray(data)
+    raster.FlushCache()
+    raster = None
+
+def generate_synthetic_catchment(output_path, grid_size=1000, n_HRUs=400, n_ice_HRUs=50, n_years=20, first_year=2000, resolution=25., seed=0, n_glaciers=1):
+    # Rectangular HRUs on a grid_size x grid_size grid, the first n_ice_HRUs being glacierized (land use #7),
+    # and a shrinking ice dome over them split into n_glaciers overlapping IceDepth_Glacier_<ID>_<year>.tif per year
+    rng = np.random.default_rng(seed)
+    hru_path = os.path.join(output_path, 'HRUs')
+    glacier_thickness_path = os.path.join(output_path, 'glacier_thickness', 'original_glacier_thickness')
+    os.makedirs(hru_path, exist_ok=True)
+    os.makedirs(glacier_thickness_path, exist_ok=True)
+
+    n_HRU_cols = int(np.ceil(np.sqrt(n_HRUs)))
+    n_HRU_rows = int(np.ceil(n_HRUs/n_HRU_cols))
+    rows, cols = np.mgrid[0:grid_size, 0:grid_size]
+    HRUs = np.minimum((rows*n_HRU_rows//grid_size)*n_HRU_cols + cols*n_HRU_cols//grid_size, n_HRUs - 1) + 1
+
+    is_ice_HRU = HRUs <= n_ice_HRUs
+    landuse_HRU = np.where(is_ice_HRU, 7, rng.integers(1, 7, size=n_HRUs + 1)[HRUs]).astype(np.uint8)
+
+    geo_transform = (0., resolution, 0., grid_size*resolution, 0., -resolution)
+    write_raster(os.path.join(hru_path, 'hru_cat.tif'), HRUs.astype(np.int32), geo_transform, gdal.GDT_Int32)
+    write_raster(os.path.join(hru_path, 'hru_landuse.tif'), landuse_HRU, geo_transform, gdal.GDT_Byte)
+
+    # The glacier rasters only cover the bounding box of the glacierized HRUs, split in column bands overlapping their neighbours
+    ice_rows, ice_cols = np.where(is_ice_HRU)
+    row_start, row_end, col_start, col_end = ice_rows.min(), ice_rows.max() + 1, ice_cols.min(), ice_cols.max() + 1
+    glacier_rows, glacier_cols = np.mgrid[row_start:row_end, col_start:col_end]
+    distance = np.hypot((glacier_rows - (row_start + row_end)/2)/(row_end - row_start), (glacier_cols - (col_start + col_end)/2)/(col_end - col_start))
+    band_edges = np.linspace(col_start, col_end, n_glaciers + 1).astype(int)
+    overlap_cols = (col_end - col_start)//(4*n_glaciers)
+    for year_idx in range(n_years):
+        glacier_thickness = 200*(1 - 4*distance**2) - 5*year_idx + rng.normal(0, 2, distance.shape)
+        glacier_thickness = np.clip(glacier_thickness, 0, None).astype(np.float32)
+        for glacier_idx in range(n_glaciers):
+            band_start, band_end = max(band_edges[glacier_idx] - overlap_cols, col_start), min(band_edges[glacier_idx + 1] + overlap_cols, col_end)
+            glacier_geo_transform = (band_start*resolution, resolution, 0., (grid_size - row_start)*resolution, 0., -resolution)
+            write_raster(os.path.join(glacier_thickness_path, 'IceDepth_Glacier_' + '%05d' % (glacier_idx + 1) + '_' + str(first_year + year_idx) + '.tif'), 
+                         glacier_thickness[:, band_start - col_start:band_end - col_start], glacier_geo_transform, gdal.GDT_Float32)
+
+    return hru_path, glacier_thickness_path
+
+def run_timed_variant(hru_path, glacier_thickness_path, output_path, variant_options, backend='numpy'):
+    # Uncached glacier_hru_evolution run, with the wall time of each stage of its run report (summed over the years
+    # and workers) and of the whole run in seconds. Returns the timings, the run counters and the written .dat file
+    os.makedirs(output_path, exist_ok=True)
+    start = time.perf_counter()
+    run = ghe.run_glacier_hru_evolution(hru_path, glacier_thickness_path, output_path, aligned_glacier_thickness_path=output_path + os.sep, 
+                                        overlap_matrices_path=os.path.join(output_path, 'overlap_matrices'), use_cache=False, write_run_report=True, 
+                                        compute_backend=backend, **variant_options)
+    timings = dict((stage, stage_total['wall_time']) for stage, stage_total in run['run_report']['stage_totals'].items())
+    timings['total'] = time.perf_counter() - start
+
+    return timings, run['run_report']['counters'], run['output_path'] + '.dat'
+
+def check_golden_output(dat_path, golden_path=golden_output_path):
+    # Compare the daily glacier fractions with the golden output over their common dates
+    output = pd.read_csv(dat_path, sep=' ', index_col=0, float_precision='round_trip')
+    golden = pd.read_csv(golden_path, sep=' ', index_col=0, float_precision='round_trip')
+    common_dates = output.index.intersection(golden.index)
+    same_HRUs = list(output.columns) == list(golden.columns)
+    max_abs_diff = float(np.abs(output.loc[common_dates].values - golden.loc[common_dates].values).max()) if (same_HRUs and common_dates.size > 0) else None
+
+    return {'golden_file': os.path.basename(golden_path), 'common_days': int(common_dates.size), 'same_HRUs': same_HRUs,
+            'max_abs_diff': max_abs_diff, 'passed': bool(same_HRUs and common_dates.size > 0 and max_abs_diff == 0)}
+
+def check_overlap_alignment(benchmark_path, backend, tolerance=1e-12):
+    # Annual glacier fractions of the overlap alignment mode against the in_memory mode on a catchment with two overlapping glaciers
+    catchment_path = os.path.join(benchmark_path, 'overlap_check')
+    hru_path, glacier_thickness_path = generate_synthetic_catchment(catchment_path, grid_size=200, n_HRUs=100, n_ice_HRUs=20, n_years=3, n_glaciers=2)
+    HRU_evolution_dfs = {}
+    for alignment_mode in ['in_memory', 'overlap']:
+        output_path = os.path.join(catchment_path, alignment_mode)
+        os.makedirs(output_path, exist_ok=True)
+        HRU_evolution_dfs[alignment_mode] = ghe.run_glacier_hru_evolution(hru_path, glacier_thickness_path, output_path, alignment_mode=alignment_mode, n_workers=1, 
+                                                                          use_cache=False, write_run_report=False, compute_backend=backend)['HRU_evolution_df']
+    max_abs_diff = float(np.abs(HRU_evolution_dfs['overlap'].values - HRU_evolution_dfs['in_memory'].values).max())
+
+    return {'max_abs_diff': max_abs_diff, 'passed': bool(max_abs_diff <= tolerance)}
+
+def get_version():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=workspace, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def save_results(results_path, benchmark_run):
+    # Every run is appended to the results file to track regressions between versions
+    benchmark_runs = []
+    if(os.path.isfile(results_path)):
+        with open(results_path) as results_file:
+            benchmark_runs = json.load(results_file)
+    benchmark_runs.append(benchmark_run)
+    with open(results_path, 'w') as results_file:
+        json.dump(benchmark_runs, results_file, indent=2)
+
+
+###############################################################################
+###                           MAIN                                          ###
+###############################################################################
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark of glacier_hru_evolution.py on synthetic catchments")
+    parser.add_argument('--grid-size', type=int, default=1000, help="Rows and columns of the synthetic HRU grid")
+    parser.add_argument('--n-hrus', type=int, default=400, help="Number of HRUs")
+    parser.add_argument('--n-ice-hrus', type=int, default=50, help="Number of glacierized HRUs")
+    parser.add_argument('--n-years', type=int, default=20, help="Number of yearly glacier ice thickness rasters")
+    parser.add_argument('--repeat', type=int, default=3, help="Repetitions, the fastest one is kept for each stage")
+    parser.add_argument('--results', default=os.path.join(workspace, 'benchmark_results.json'), help="JSON file the results are appended to")
+    parser.add_argument('--backend', choices=['numba', 'numpy'], default=ghe.compute_backend, help="Backend of the pixel reduction and daily interpolation")
+    parser.add_argument('--skip-golden', action='store_true', help="Skip the golden output check on the Arvan data")
+    args = parser.parse_args()
+    backend = ghe.set_compute_backend(args.backend)
+
+    benchmark_path = tempfile.mkdtemp(prefix='glacier_hru_benchmark_')
+    try:
+        hru_path, glacier_thickness_path = generate_synthetic_catchment(benchmark_path, args.grid_size, args.n_hrus, args.n_ice_hrus, args.n_years)
+
+        # The fastest repetition is kept for each stage of each variant
+        variant_timings = dict((variant, {}) for variant in variants)
+        for variant, variant_options in variants.items():
+            for repetition in range(args.repeat):
+                timings, counters = run_timed_variant(hru_path, glacier_thickness_path, os.path.join(benchmark_path, variant), variant_options, backend)[:2]
+                for stage, stage_time in timings.items():
+                    variant_timings[variant][stage] = min(stage_time, variant_timings[variant].get(stage, stage_time))
+
+        benchmark_run = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                         'version': get_version(),
+                         'parameters': {'grid_size': args.grid_size, 'n_HRUs': args.n_hrus, 'n_ice_HRUs': args.n_ice_hrus, 'n_years': args.n_years, 'repeat': args.repeat,
+                                        'backend': backend, 'variants': variants},
+                         'counters': counters,
+                         'stages': variant_timings}
+
+        benchmark_run['overlap_check'] = check_overlap_alignment(benchmark_path, backend)
+
+        # The .dat file written by each variant on the Arvan data is checked against the golden output
+        if(not args.skip_golden):
+            benchmark_run['golden_check'] = {}
+            for variant, variant_options in variants.items():
+                arvan_dat_path = run_timed_variant(arvan_hru_path, arvan_glacier_thickness_path, os.path.join(benchmark_path, 'arvan_' + variant), variant_options, backend)[2]
+                benchmark_run['golden_check'][variant] = check_golden_output(arvan_dat_path)
+    finally:
+        shutil.rmtree(benchmark_path, ignore_errors=True)
+
+    for variant in variants:
+        print("\n" + variant + ": " + ", ".join(stage + " " + "{:.4f}".format(stage_time) + " s" for stage, stage_time in benchmark_run['stages'][variant].items()))
+    print("\nOverlap alignment check: " + ("passed" if benchmark_run['overlap_check']['passed'] else "FAILED") + " " + str(benchmark_run['overlap_check']))
+    golden_passed = True
+    for variant, golden_check in benchmark_run.get('golden_check', {}).items():
+        print("\nGolden output check (" + variant + "): " + ("passed" if golden_check['passed'] else "FAILED") + " " + str(golden_check))
+        golden_passed = golden_passed and golden_check['passed']
+
+    save_results(args.results, benchmark_run)
+    print("\nResults saved in " + args.results)
+
+    if(not benchmark_run['overlap_check']['passed'] or not golden_passed):
+        sys.exit(1)
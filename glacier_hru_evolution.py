@@ -12,7 +12,6 @@ J2K HYDROLOGICAL MODEL
 
 ## Dependencies: ##
 import os
-#from numba import jit
 #from osgeo import gdal, ogr
 import pandas as pd
 #import datetime
@@ -20,176 +19,1303 @@ import pandas as pd
 #import matplotlib.backends.backend_pdf
 import numpy as np
 import copy
-from pathlib import Path
 #from glacier_evolution import array2raster, getRasterInfo
 
 import subprocess, os,  sys, glob
-try:
-    from osgeo import gdal
-    from osgeo import osr
-except:
-    import gdal
-#    import osr
+import multiprocessing
+import hashlib
+import contextlib
+import cProfile
+import json
+import time
+import argparse
+import collections
+import concurrent.futures
+import threading
+
+# GDAL is only imported when first needed (see load_gdal)
+gdal = None
+
+# numba kernels, compiled when the numba backend is selected (see set_compute_backend)
+numba_kernels = None
+compiled_numba_kernels = None
+prange = range
 
 command = ["gdalbuildvrt","-te"]
 
+# Stages being recorded in this process: the peak RSS is only reset when none is running, so the peak read at
+# the end of a stage covers all of it (and possibly the stages overlapping it in other threads)
+active_stages = {'count': 0, 'lock': threading.Lock()}
+
+# Rows of the zonal statistics matrix: ice pixels, glacierized fraction, ice volume (summed thickness times the cell area
+# of the HRU grid), mean thickness of the ice pixels and max thickness of each HRU
+zonal_statistic_names = ['ice_pixels', 'fraction', 'ice_volume', 'mean_thickness', 'max_thickness']
+
+######   DEFAULT OPTIONS    #######
+
+# Raster alignment mode: 'in_memory' pastes each thickness raster in a preallocated buffer aligned
+# with the HRU grid, 'vrt' uses the reference gdalbuildvrt approach writing a VRT file per year and
+# 'overlap' weights the raw thickness pixels by their area overlap with each HRU, for thickness rasters
+# on a different grid (overlap matrices are computed once per source grid and saved to disk, and the glaciers of a
+# year sharing a source grid are merged before applying them)
+alignment_mode = 'in_memory'
+
+# Tiled processing of the HRU and thickness rasters in windows aligned to the GDAL block size,
+# with at least min_tile_size pixels per side, to bound memory on large domains
+tiled = False
+min_tile_size = 512
+
+# Number of worker processes aligning and reducing the glacier thickness rasters (1 = serial run)
+n_workers = 1
+
+# Serial runs read the thickness rasters of the next n_prefetch years in background threads while the
+# current year is reduced and interpolated, holding n_prefetch years in memory besides the current one (0 = no prefetching)
+n_prefetch = 2
+
+# Persistent cache of the annual glacier fractions per HRU, evicting the least recently used
+# entries above max_cache_size bytes (run the script with --clear-cache to invalidate it)
+use_cache = True
+max_cache_size = 2**30
+
+# Output formats of the daily glacier fractions: 'dat' (read by J2K), 'npy' (memory-mappable matrix
+# with its date and HRU ID index arrays) and 'parquet'. The 'fast' .dat writer streams chunks of rows
+# formatted with dat_precision decimals (None = full precision, byte-identical to the 'pandas' writer)
+output_formats = ['dat']
+dat_writer = 'fast'
+dat_precision = None
+dat_chunk_size = 1000
+
+# Streaming mode: each hydrological year is appended to the .dat/.npy outputs as soon as it is
+# interpolated, keeping memory flat whatever the number of years (Parquet is not streamed)
+streaming = False
+
+# Run report with the wall time, CPU time, RSS at the start and end and peak RSS of each stage and year plus run counters,
+# saved as <output>_run_report.json, and optional cProfile dump of the main process (<output>.prof)
+write_run_report = True
+profile_run = False
+
+# (month, day) of the switch from the accumulation to the ablation season
+ablation_start = (6, 1)
+
+# Backend of the pixel reduction and daily interpolation: 'numba' runs compiled parallel kernels
+# (falling back to 'numpy' if numba is not installed), both giving identical results
+compute_backend = 'numba'
+
+# Extra per-HRU statistics reduced in the same pass over the pixels as the glacier fractions (see zonal_statistic_names),
+# each written to HRU_glacier_<statistic>_<first year>_<last year>.dat next to the glacier fractions, with 'annual' values
+# (end of each hydrological year) or 'daily' values interpolated as the glacier fractions. Both backends give identical
+# statistics, but the ice volume and mean thickness of tiled runs sum the pixels tile by tile and may differ from untiled
+# runs by rounding (relative differences around 1e-15); the ice pixels, fractions and max thickness are identical
+zonal_statistics = []
+zonal_statistics_frequency = 'annual'
+
 ######   FILE PATHS    #######
-workspace = str(Path(os.getcwd())) + '\\'
-#root = str(workspace.parent) + '\\'
-hru_path = workspace + 'HRUs\\'
-hru_glacier_fractions_path = workspace + 'HRU_glacier_fractions\\'
-original_glacier_thickness_path = workspace + 'glacier_thickness\\original_glacier_thickness\\'
-aligned_glacier_thickness_path = workspace + 'glacier_thickness\\aligned_glacier_thickness\\'
 
-# List of paths to glacier ice thickness raster data
-list_path_glacier_thickness = np.asarray(os.listdir(original_glacier_thickness_path))
+def get_intermediate_paths(original_glacier_thickness_path):
+    # Intermediate folders, subfolders of the folder containing the glacier thickness rasters folder
+    glacier_thickness_path = os.path.dirname(os.path.normpath(original_glacier_thickness_path))
+    return {'aligned_glacier_thickness_path': os.path.join(glacier_thickness_path, 'aligned_glacier_thickness'),
+            'overlap_matrices_path': os.path.join(glacier_thickness_path, 'overlap_matrices'),
+            'glacier_fractions_cache_path': os.path.join(glacier_thickness_path, 'glacier_fractions_cache')}
+
+def get_default_paths(workspace):
+    # Input, output and intermediate folders of a catchment workspace
+    original_glacier_thickness_path = os.path.join(workspace, 'glacier_thickness', 'original_glacier_thickness')
+    return dict({'hru_path': os.path.join(workspace, 'HRUs'),
+                 'original_glacier_thickness_path': original_glacier_thickness_path,
+                 'hru_glacier_fractions_path': os.path.join(workspace, 'HRU_glacier_fractions')}, 
+                **get_intermediate_paths(original_glacier_thickness_path))
 
 
 ###############################################################################
 ###                           FUNCTIONS                                     ###
 ###############################################################################
 
-def align_rasters(raster_HRU_landuse, full_path_glacier_thickness, aligned_glacier_thickness_path):
-    #### Open raster data ###
-    adfGeoTransform = raster_HRU_landuse.GetGeoTransform(can_return_null = True)
+def load_gdal():
+    # Lazy GDAL import, done once per process
+    global gdal
+    if(gdal is None):
+        try:
+            from osgeo import gdal as osgeo_gdal
+        except ImportError:
+            import gdal as osgeo_gdal
+        gdal = osgeo_gdal
+    
+    return gdal
+
+def build_vrt(adfGeoTransform, landuse_size, full_path_glacier_thickness, aligned_glacier_thickness_path, year, glacier_ID=None):
+    # The land use grid is given by its GeoTransform and (cols, rows) size rather than its dataset, which cannot be shared between threads
+    landuse_cols, landuse_rows = landuse_size
     
     # We align the glacier ice thickness with the interpolated land use raster
     if adfGeoTransform is not None:
         dfGeoXUL = adfGeoTransform[0] 
         dfGeoYUL = adfGeoTransform[3] 
-        dfGeoXLR = adfGeoTransform[0] + adfGeoTransform[1] * raster_HRU_landuse.RasterXSize + adfGeoTransform[2] * raster_HRU_landuse.RasterYSize
-        dfGeoYLR = adfGeoTransform[3] + adfGeoTransform[4] * raster_HRU_landuse.RasterXSize + adfGeoTransform[5] * raster_HRU_landuse.RasterYSize
+        dfGeoXLR = adfGeoTransform[0] + adfGeoTransform[1] * landuse_cols + adfGeoTransform[2] * landuse_rows
+        dfGeoYLR = adfGeoTransform[3] + adfGeoTransform[4] * landuse_cols + adfGeoTransform[5] * landuse_rows
         xres = str(abs(adfGeoTransform[1]))
         yres = str(abs(adfGeoTransform[5]))
-        vrt_glacier_thick_path = aligned_glacier_thickness_path + "glacier_" + year + "_VRT.vrt"
+        if(glacier_ID is None):
+            vrt_glacier_thick_path = os.path.join(aligned_glacier_thickness_path, "glacier_" + str(year) + "_VRT.vrt")
+        else:
+            vrt_glacier_thick_path = os.path.join(aligned_glacier_thickness_path, "glacier_" + glacier_ID + "_" + str(year) + "_VRT.vrt")
         subprocess.call(command +[ str(dfGeoXUL), str(dfGeoYLR), str(dfGeoXLR), str(dfGeoYUL), "-tr", xres, yres, vrt_glacier_thick_path, full_path_glacier_thickness])
+    
+    return vrt_glacier_thick_path
 
-    # We open the aligned VRT glacier ice thickness raster
-    raster_current_glacier = gdal.Open(vrt_glacier_thick_path, gdal.GA_ReadOnly) 
-    current_glacier_thickness = raster_current_glacier.ReadAsArray()
+def get_raster_offsets(adfGeoTransform, raster_glacier):
+    # Pixel offsets of the glacier raster within the HRU grid
+    glacierGeoTransform = raster_glacier.GetGeoTransform()
+    
+    # Only rasters sharing the HRU grid resolution can be pasted without resampling
+    if(adfGeoTransform is None or glacierGeoTransform[2] != 0 or glacierGeoTransform[4] != 0 or 
+       not np.isclose(glacierGeoTransform[1], adfGeoTransform[1]) or not np.isclose(glacierGeoTransform[5], adfGeoTransform[5])):
+        return None
     
-    return current_glacier_thickness
+    x_off = int(round((glacierGeoTransform[0] - adfGeoTransform[0])/adfGeoTransform[1]))
+    y_off = int(round((glacierGeoTransform[3] - adfGeoTransform[3])/adfGeoTransform[5]))
+    
+    return x_off, y_off
 
-def interpolate_glacier_fractions(hydro_year_range, hru_idx):
-    current_HRU_ice_fraction = []
-    for day in hydro_year_range:
-#                print(day)
-        if(day < (pd.Timestamp(int(year), 6, 1))):
-            # Same glacierized percentage during accumulation season
-            current_HRU_ice_fraction.append(float(raw_HRU_glacier_evolution[-1,hru_idx+1]))
-        else:
-            # Append the transition between the previous ice fraction and current year's
-            current_HRU_ice_fraction = np.concatenate((current_HRU_ice_fraction, np.linspace(current_HRU_ice_fraction[-1], glacierized_perc_HRU, num=(hydro_year_range[-1] - day).days+1)))
-            break
+def read_aligned_window(raster_glacier, x_off, y_off, window):
+    # Read the part of the glacier raster overlapping a (x, y, cols, rows) window of the HRU grid,
+    # returned with its (x, y) position within the window
+    win_x, win_y, win_cols, win_rows = window
+    x_start, x_end = max(x_off, win_x), min(x_off + raster_glacier.RasterXSize, win_x + win_cols)
+    y_start, y_end = max(y_off, win_y), min(y_off + raster_glacier.RasterYSize, win_y + win_rows)
+    
+    # Glaciers outside the window are skipped without reading them
+    if(x_end <= x_start or y_end <= y_start):
+        return None
+    
+    glacier_thickness = raster_glacier.ReadAsArray(x_start - x_off, y_start - y_off, x_end - x_start, y_end - y_start)
+    
+    return x_start - win_x, y_start - win_y, glacier_thickness
+
+def paste_aligned_window(glacier_window, aligned_glacier_thickness):
+    # Add the ice thickness of a glacier window read with read_aligned_window
+    x, y, glacier_thickness = glacier_window
+    aligned_glacier_thickness[y:y + glacier_thickness.shape[0], x:x + glacier_thickness.shape[1]] += np.where(glacier_thickness > 0, glacier_thickness, 0)
+
+def accumulate_aligned_window(raster_glacier, x_off, y_off, window, aligned_glacier_thickness):
+    # Add the ice thickness of the part of the glacier raster overlapping a (x, y, cols, rows) window of the HRU grid
+    glacier_window = read_aligned_window(raster_glacier, x_off, y_off, window)
+    if(glacier_window is None):
+        return False
+    paste_aligned_window(glacier_window, aligned_glacier_thickness)
+    
+    return True
+
+def open_aligned_raster(full_path_glacier_thickness):
+    # Open a glacier ice thickness raster with its pixel offsets within the HRU grid
+    gdal = load_gdal()
+    raster_glacier = gdal.Open(full_path_glacier_thickness, gdal.GA_ReadOnly)
+    raster_offsets = None
+    if(worker_state['alignment_mode'] == 'in_memory'):
+        raster_offsets = get_raster_offsets(worker_state['landuse_GeoTransform'], raster_glacier)
+    
+    if(raster_offsets is None):
+        # Reference VRT alignment (also used for rasters with a different resolution), already aligned with the HRU grid
+        glacier_ID = full_path_glacier_thickness[-14:-9]
+        year = full_path_glacier_thickness[-8:-4]
+        vrt_glacier_thick_path = build_vrt(worker_state['landuse_GeoTransform'], worker_state['landuse_size'], full_path_glacier_thickness, worker_state['aligned_glacier_thickness_path'], year, glacier_ID)
+        raster_glacier = gdal.Open(vrt_glacier_thick_path, gdal.GA_ReadOnly)
+        raster_offsets = (0, 0)
+    
+    return raster_glacier, raster_offsets[0], raster_offsets[1]
+
+def get_raster_tiles(raster, min_tile_size):
+    # (x, y, cols, rows) windows covering the raster, aligned to its GDAL block size
+    block_cols, block_rows = raster.GetRasterBand(1).GetBlockSize()
+    tile_cols = block_cols*int(np.ceil(min_tile_size/block_cols))
+    tile_rows = block_rows*int(np.ceil(min_tile_size/block_rows))
+    for y in range(0, raster.RasterYSize, tile_rows):
+        for x in range(0, raster.RasterXSize, tile_cols):
+            yield (x, y, min(tile_cols, raster.RasterXSize - x), min(tile_rows, raster.RasterYSize - y))
+
+def index_HRU_tiles(raster_HRU, raster_HRU_landuse, min_tile_size):
+    # Glacierized HRUs only from the tiles with ice (land use #7) pixels
+    tile_HRUs_ID_ice = []
+    for tile in get_raster_tiles(raster_HRU_landuse, min_tile_size):
+        landuse_tile = raster_HRU_landuse.ReadAsArray(*tile)
+        if(np.any(landuse_tile == 7)):
+            tile_HRUs_ID_ice.append(np.unique(raster_HRU.ReadAsArray(*tile)[landuse_tile == 7]))
+    HRUs_ID_ice = np.unique(np.concatenate(tile_HRUs_ID_ice)) if tile_HRUs_ID_ice else np.array([])
+    
+    # Only the windows of the tiles with glacierized HRU pixels are kept, their pixels being indexed again from the
+    # HRU tile when it has ice, so memory stays bounded by the tile size whatever the glacierized share of the domain
+    HRU_tiles = []
+    HRU_pixel_count = np.zeros(HRUs_ID_ice.size, dtype=np.int64)
+    for tile in get_raster_tiles(raster_HRU, min_tile_size):
+        glacier_HRU_pixels, glacier_HRU_labels, tile_pixel_count = index_HRU_pixels(raster_HRU.ReadAsArray(*tile), HRUs_ID_ice)
+        if(glacier_HRU_pixels.size > 0):
+            HRU_tiles.append(tile)
+            HRU_pixel_count += tile_pixel_count
+    
+    return HRUs_ID_ice, HRU_tiles, HRU_pixel_count
+
+def index_HRU_pixels(HRUs, HRUs_ID_ice):
+    # Maps once every HRU raster pixel belonging to a glacierized HRU to its position in HRUs_ID_ice
+    flat_HRUs = HRUs.ravel()
+    HRU_pos = np.searchsorted(HRUs_ID_ice, flat_HRUs)
+    HRU_pos[HRU_pos == HRUs_ID_ice.size] = 0
+    glacier_HRU_pixels = np.flatnonzero(HRUs_ID_ice[HRU_pos] == flat_HRUs)
+    glacier_HRU_labels = HRU_pos[glacier_HRU_pixels]
+    
+    # The pixels are grouped by HRU once, keeping their raster order within each HRU (stable sort)
+    HRU_order = np.argsort(glacier_HRU_labels, kind='stable')
+    glacier_HRU_pixels, glacier_HRU_labels = glacier_HRU_pixels[HRU_order], glacier_HRU_labels[HRU_order]
+    
+    # Total number of pixels of each glacierized HRU
+    HRU_pixel_count = np.bincount(glacier_HRU_labels, minlength=HRUs_ID_ice.size)
+    
+    return glacier_HRU_pixels, glacier_HRU_labels, HRU_pixel_count
+
+def get_HRU_offsets(HRU_pixel_count):
+    # Start of the pixels of each HRU (and end of the last one) in the labelled pixels grouped by HRU
+    return np.concatenate(([0], np.cumsum(HRU_pixel_count))).astype(np.int64)
+
+def count_glacier_pixels_kernel(glacier_thickness, glacier_HRU_pixels, glacier_HRU_labels, n_HRUs, n_chunks):
+    # Thresholding and counting of the ice pixels of each HRU fused in a single loop, each chunk of pixels
+    # counted in parallel in its own row to avoid write conflicts
+    chunk_counts = np.zeros((n_chunks, n_HRUs))
+    chunk_size = (glacier_HRU_pixels.size + n_chunks - 1)//n_chunks
+    for chunk in prange(n_chunks):
+        for idx in range(chunk*chunk_size, min((chunk + 1)*chunk_size, glacier_HRU_pixels.size)):
+            if(glacier_thickness[glacier_HRU_pixels[idx]] > 0):
+                chunk_counts[chunk, glacier_HRU_labels[idx]] += 1.
+    
+    return chunk_counts.sum(axis=0)
+
+def reduce_zonal_statistics_kernel(glacier_thickness, glacier_HRU_pixels, glacier_HRU_offsets, n_HRUs):
+    # Ice pixel count, summed thickness and max thickness of each HRU. The pixels being grouped by HRU in their raster order,
+    # each HRU is reduced in parallel in that order, so the thickness is summed as np.bincount does
+    HRU_statistics = np.zeros((3, n_HRUs))
+    for HRU in prange(n_HRUs):
+        for idx in range(glacier_HRU_offsets[HRU], glacier_HRU_offsets[HRU + 1]):
+            thickness = glacier_thickness[glacier_HRU_pixels[idx]]
+            if(thickness > 0):
+                HRU_statistics[0, HRU] += 1.
+                HRU_statistics[1, HRU] += thickness
+                HRU_statistics[2, HRU] = max(HRU_statistics[2, HRU], thickness)
+    
+    return HRU_statistics
+
+def interpolate_glacier_fractions_kernel(daily_glacier_fractions, previous_glacier_fractions, current_glacier_fractions, n_accumulation_days):
+    # Accumulation plateau and ablation ramp of all HRUs, with the days filled in parallel
+    n_days, n_HRUs = daily_glacier_fractions.shape
+    n_ablation_days = n_days - n_accumulation_days
+    ablation_step = np.zeros(n_HRUs)
+    if(n_ablation_days > 1):
+        ablation_step = (current_glacier_fractions - previous_glacier_fractions)/(n_ablation_days - 1)
+    for day in prange(n_days):
+        for HRU in range(n_HRUs):
+            if(day < n_accumulation_days or n_ablation_days == 1):
+                daily_glacier_fractions[day, HRU] = previous_glacier_fractions[HRU]
+            elif(day == n_days - 1):
+                daily_glacier_fractions[day, HRU] = current_glacier_fractions[HRU]
+            else:
+                daily_glacier_fractions[day, HRU] = (day - n_accumulation_days)*ablation_step[HRU] + previous_glacier_fractions[HRU]
+
+def set_compute_backend(backend):
+    # Selects the numba kernels ('numba') or the NumPy path ('numpy'), returning the backend in use
+    global numba_kernels, compiled_numba_kernels, prange
+    numba_kernels = None
+    if(backend != 'numba'):
+        return 'numpy'
+    try:
+        import numba
+    except ImportError:
+        print("\nnumba not available, using the NumPy backend")
+        return 'numpy'
+    
+    # Kernels are only compiled once per process (and cached on disk across runs)
+    if(compiled_numba_kernels is None):
+        prange = numba.prange
+        compiled_numba_kernels = {'count_glacier_pixels': numba.njit(parallel=True, cache=True)(count_glacier_pixels_kernel),
+                                  'reduce_zonal_statistics': numba.njit(parallel=True, cache=True)(reduce_zonal_statistics_kernel),
+                                  'interpolate_glacier_fractions': numba.njit(parallel=True, cache=True)(interpolate_glacier_fractions_kernel),
+                                  'n_threads': numba.get_num_threads()}
+    numba_kernels = compiled_numba_kernels
+    
+    return 'numba'
+
+def count_glacier_pixels(current_glacier_thickness, glacier_HRU_pixels, glacier_HRU_labels, n_HRUs):
+    # Single pass over the labelled pixels counting the ice pixels of each HRU
+    if(numba_kernels is not None):
+        return numba_kernels['count_glacier_pixels'](current_glacier_thickness.ravel(), glacier_HRU_pixels, glacier_HRU_labels, n_HRUs, numba_kernels['n_threads'])
+    
+    glacier_pixels = current_glacier_thickness.ravel()[glacier_HRU_pixels] > 0
+    
+    return np.bincount(glacier_HRU_labels, weights=glacier_pixels, minlength=n_HRUs)
+
+def compute_glacier_fractions(current_glacier_thickness, glacier_HRU_pixels, glacier_HRU_labels, HRU_pixel_count):
+    # Ice pixels per HRU divided by the HRU size
+    HRU_ice_pixel_count = count_glacier_pixels(current_glacier_thickness, glacier_HRU_pixels, glacier_HRU_labels, HRU_pixel_count.size)
+    
+    return HRU_ice_pixel_count/HRU_pixel_count
+
+def reduce_zonal_statistics(current_glacier_thickness, glacier_HRU_pixels, glacier_HRU_labels, glacier_HRU_offsets, n_HRUs):
+    # Single pass over the labelled pixels reducing the (3 x HRUs) ice pixel count, summed thickness and max thickness of each HRU
+    if(numba_kernels is not None):
+        return numba_kernels['reduce_zonal_statistics'](current_glacier_thickness.ravel(), glacier_HRU_pixels, glacier_HRU_offsets, n_HRUs)
+    
+    glacier_thickness = current_glacier_thickness.ravel()[glacier_HRU_pixels]
+    glacier_pixels = glacier_thickness > 0
+    glacier_thickness = np.where(glacier_pixels, glacier_thickness, 0)
+    HRU_max_thickness = np.zeros(n_HRUs)
+    np.maximum.at(HRU_max_thickness, glacier_HRU_labels, glacier_thickness)
+    
+    return np.vstack((np.bincount(glacier_HRU_labels, weights=glacier_pixels, minlength=n_HRUs), 
+                      np.bincount(glacier_HRU_labels, weights=glacier_thickness, minlength=n_HRUs), HRU_max_thickness))
+
+def get_zonal_statistics(HRU_ice_pixel_count, HRU_glacier_fractions, HRU_thickness_sum, HRU_max_thickness, cell_area):
+    # Zonal statistics matrix (rows in zonal_statistic_names order), with a mean thickness of 0 for the HRUs without ice
+    HRU_mean_thickness = np.zeros(HRU_ice_pixel_count.size)
+    np.divide(HRU_thickness_sum, HRU_ice_pixel_count, out=HRU_mean_thickness, where=HRU_ice_pixel_count > 0)
+    
+    return np.vstack((HRU_ice_pixel_count, HRU_glacier_fractions, HRU_thickness_sum*cell_area, HRU_mean_thickness, HRU_max_thickness))
+
+def compute_zonal_statistics(current_glacier_thickness, glacier_HRU_pixels, glacier_HRU_labels, glacier_HRU_offsets, HRU_pixel_count, cell_area):
+    # All the zonal statistics of each HRU from a single reduction, the glacier fractions being the same as compute_glacier_fractions
+    HRU_ice_pixel_count, HRU_thickness_sum, HRU_max_thickness = reduce_zonal_statistics(current_glacier_thickness, glacier_HRU_pixels, glacier_HRU_labels, 
+                                                                                        glacier_HRU_offsets, HRU_pixel_count.size)
+    
+    return get_zonal_statistics(HRU_ice_pixel_count, HRU_ice_pixel_count/HRU_pixel_count, HRU_thickness_sum, HRU_max_thickness, cell_area)
+
+def generate_aligned_tiles(aligned_rasters_glacier, HRU_tiles, raster_HRU, HRUs_ID_ice, stage_counters=None):
+    # Yields (thickness tile, tile pixels, tile labels, tile HRU offsets) of the tiles with ice, aligned and indexed one at a time
+    # (reading the HRU tile again) so memory is bounded by the tile size. The pixels indexed and reduced are added to the
+    # optional stage counters
+    for tile in HRU_tiles:
+        glacier_thickness_tile = np.zeros((tile[3], tile[2]))
+        tile_has_ice = False
+        for raster_glacier, x_off, y_off in aligned_rasters_glacier:
+            tile_has_ice = accumulate_aligned_window(raster_glacier, x_off, y_off, tile, glacier_thickness_tile) or tile_has_ice
+        if(tile_has_ice):
+            glacier_HRU_pixels, glacier_HRU_labels, tile_pixel_count = index_HRU_pixels(raster_HRU.ReadAsArray(*tile), HRUs_ID_ice)
+            if(stage_counters is not None):
+                stage_counters['indexed_pixels'] += tile[2]*tile[3]
+                stage_counters['pixels'] += glacier_HRU_pixels.size
+            yield glacier_thickness_tile, glacier_HRU_pixels, glacier_HRU_labels, get_HRU_offsets(tile_pixel_count)
+
+def compute_tiled_glacier_fractions(aligned_rasters_glacier, HRU_tiles, raster_HRU, HRUs_ID_ice, HRU_pixel_count, stage_counters=None):
+    # Ice pixels per HRU accumulated tile by tile
+    HRU_ice_pixel_count = np.zeros(HRU_pixel_count.size)
+    for glacier_thickness_tile, glacier_HRU_pixels, glacier_HRU_labels, glacier_HRU_offsets in generate_aligned_tiles(aligned_rasters_glacier, HRU_tiles, raster_HRU, HRUs_ID_ice, 
+                                                                                                                      stage_counters):
+        HRU_ice_pixel_count += count_glacier_pixels(glacier_thickness_tile, glacier_HRU_pixels, glacier_HRU_labels, HRU_pixel_count.size)
+    
+    return HRU_ice_pixel_count/HRU_pixel_count
+
+def compute_tiled_zonal_statistics(aligned_rasters_glacier, HRU_tiles, raster_HRU, HRUs_ID_ice, HRU_pixel_count, cell_area, stage_counters=None):
+    # Ice pixels, summed thickness and max thickness per HRU accumulated tile by tile
+    HRU_ice_pixel_count, HRU_thickness_sum, HRU_max_thickness = np.zeros((3, HRU_pixel_count.size))
+    for glacier_thickness_tile, glacier_HRU_pixels, glacier_HRU_labels, glacier_HRU_offsets in generate_aligned_tiles(aligned_rasters_glacier, HRU_tiles, raster_HRU, HRUs_ID_ice, 
+                                                                                                                      stage_counters):
+        tile_ice_pixel_count, tile_thickness_sum, tile_max_thickness = reduce_zonal_statistics(glacier_thickness_tile, glacier_HRU_pixels, glacier_HRU_labels, glacier_HRU_offsets, 
+                                                                                               HRU_pixel_count.size)
+        HRU_ice_pixel_count += tile_ice_pixel_count
+        HRU_thickness_sum += tile_thickness_sum
+        np.maximum(HRU_max_thickness, tile_max_thickness, out=HRU_max_thickness)
+    
+    return get_zonal_statistics(HRU_ice_pixel_count, HRU_ice_pixel_count/HRU_pixel_count, HRU_thickness_sum, HRU_max_thickness, cell_area)
+
+def interpolate_glacier_fractions(hydro_year_range, previous_glacier_fractions, current_glacier_fractions, year, ablation_start=(6, 1)):
+    # Daily (days x HRUs) glacierized fractions of the hydrological year for all HRUs at once
+    n_ablation_days = int(np.sum(hydro_year_range >= pd.Timestamp(int(year), ablation_start[0], ablation_start[1])))
+    n_accumulation_days = hydro_year_range.size - n_ablation_days
+    
+    # Same glacierized percentage during accumulation season
+    daily_glacier_fractions = np.empty((hydro_year_range.size, previous_glacier_fractions.size))
+    if(numba_kernels is not None):
+        numba_kernels['interpolate_glacier_fractions'](daily_glacier_fractions, np.ascontiguousarray(previous_glacier_fractions, dtype=np.float64), 
+                                                       np.ascontiguousarray(current_glacier_fractions, dtype=np.float64), n_accumulation_days)
+        return daily_glacier_fractions
+    
+    daily_glacier_fractions[:n_accumulation_days] = previous_glacier_fractions
+    
+    # Linear transition between the previous ice fraction and current year's during the ablation season
+    if(n_ablation_days > 1):
+        ablation_step = (current_glacier_fractions - previous_glacier_fractions)/(n_ablation_days - 1)
+        daily_glacier_fractions[n_accumulation_days:] = np.arange(n_ablation_days)[:, np.newaxis]*ablation_step + previous_glacier_fractions
+        daily_glacier_fractions[-1] = current_glacier_fractions
+    elif(n_ablation_days == 1):
+        daily_glacier_fractions[-1] = previous_glacier_fractions
         
-    return current_HRU_ice_fraction
+    return daily_glacier_fractions
         
-def initialize_dataframe(i_interp_annual_ice_fraction, i_hydro_year_range):
-    print("\nInitializing dataframe")
-    start_joining = False
-    daily_HRU_glacier_evolution_df = pd.DataFrame()
-    for hru, HRU_ID  in zip(i_interp_annual_ice_fraction, HRUs_ID_ice):
-            current_column = pd.DataFrame(data={str(int(HRU_ID)): hru}, index = i_hydro_year_range)
-            if(start_joining):
-                daily_HRU_glacier_evolution_df = daily_HRU_glacier_evolution_df.join(current_column)
+def compute_axis_overlaps(src_origin, src_res, src_size, dst_origin, dst_res, dst_size):
+    # Overlap lengths (in destination pixels) between the source and destination pixels along one axis
+    src_edges = (src_origin + src_res*np.arange(src_size + 1) - dst_origin)/dst_res
+    src_start, src_end = np.minimum(src_edges[:-1], src_edges[1:]), np.maximum(src_edges[:-1], src_edges[1:])
+    dst_start = np.clip(np.floor(src_start), 0, dst_size).astype(np.int64)
+    dst_end = np.clip(np.ceil(src_end), 0, dst_size).astype(np.int64)
+    
+    # All the (source, destination) pixel pairs of each source pixel
+    n_overlaps = dst_end - dst_start
+    src_idx = np.repeat(np.arange(src_size), n_overlaps)
+    dst_idx = np.repeat(dst_start, n_overlaps) + np.arange(n_overlaps.sum()) - np.repeat(np.cumsum(n_overlaps) - n_overlaps, n_overlaps)
+    overlap = np.minimum(src_end[src_idx], dst_idx + 1) - np.maximum(src_start[src_idx], dst_idx)
+    
+    return src_idx[overlap > 0], dst_idx[overlap > 0], overlap[overlap > 0]
+
+def compute_overlap_matrix(srcGeoTransform, src_size, raster_HRU, HRUs_ID_ice):
+    # Sparse (source pixel, HRU grid pixel) weights: area of each pixel of the glacierized HRUs covered by each source pixel,
+    # in HRU pixels, with the HRU of each pair
+    adfGeoTransform = raster_HRU.GetGeoTransform()
+    src_cols, dst_cols, x_overlap = compute_axis_overlaps(srcGeoTransform[0], srcGeoTransform[1], src_size[0], adfGeoTransform[0], adfGeoTransform[1], raster_HRU.RasterXSize)
+    src_rows, dst_rows, y_overlap = compute_axis_overlaps(srcGeoTransform[3], srcGeoTransform[5], src_size[1], adfGeoTransform[3], adfGeoTransform[5], raster_HRU.RasterYSize)
+    if(src_cols.size == 0 or src_rows.size == 0):
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([])
+    
+    # Only the window of the HRU grid under the source raster is read
+    x_start, y_start = dst_cols.min(), dst_rows.min()
+    HRU_window = raster_HRU.ReadAsArray(int(x_start), int(y_start), int(dst_cols.max() - x_start + 1), int(dst_rows.max() - y_start + 1))
+    
+    # Area overlap of every source pixel with every HRU grid pixel
+    row_pairs, col_pairs = np.repeat(np.arange(src_rows.size), src_cols.size), np.tile(np.arange(src_cols.size), src_rows.size)
+    src_pixels = src_rows[row_pairs]*src_size[0] + src_cols[col_pairs]
+    dst_pixels = dst_rows[row_pairs]*raster_HRU.RasterXSize + dst_cols[col_pairs]
+    HRU_labels = HRU_window[dst_rows[row_pairs] - y_start, dst_cols[col_pairs] - x_start]
+    overlap = y_overlap[row_pairs]*x_overlap[col_pairs]
+    
+    # Keep the pixels of the glacierized HRUs
+    HRU_pos = np.searchsorted(HRUs_ID_ice, HRU_labels)
+    HRU_pos[HRU_pos == HRUs_ID_ice.size] = 0
+    is_glacier_HRU = HRUs_ID_ice[HRU_pos] == HRU_labels
+    
+    return src_pixels[is_glacier_HRU], dst_pixels[is_glacier_HRU], HRU_pos[is_glacier_HRU], overlap[is_glacier_HRU]
+
+def get_glacier_HRU_window():
+    # (x, y, cols, rows) window of the HRU grid holding the glacierized HRU pixels (the whole grid if they are not known)
+    landuse_cols, landuse_rows = worker_state['landuse_size']
+    if(worker_state['glacier_HRU_pixels'] is not None and worker_state['glacier_HRU_pixels'].size > 0):
+        rows, cols = np.divmod(worker_state['glacier_HRU_pixels'], landuse_cols)
+        return int(cols.min()), int(rows.min()), int(cols.max() - cols.min() + 1), int(rows.max() - rows.min() + 1)
+    if(worker_state['HRU_tiles']):
+        x_start, y_start = min(tile[0] for tile in worker_state['HRU_tiles']), min(tile[1] for tile in worker_state['HRU_tiles'])
+        x_end, y_end = max(tile[0] + tile[2] for tile in worker_state['HRU_tiles']), max(tile[1] + tile[3] for tile in worker_state['HRU_tiles'])
+        return x_start, y_start, x_end - x_start, y_end - y_start
+    
+    return 0, 0, landuse_cols, landuse_rows
+
+def get_source_grid_window(srcGeoTransform, adfGeoTransform, HRU_window):
+    # GeoTransform and (cols, rows) size of the part of a source grid covering a (x, y, cols, rows) window of the HRU grid
+    x_edges = adfGeoTransform[0] + adfGeoTransform[1]*np.array([HRU_window[0], HRU_window[0] + HRU_window[2]])
+    y_edges = adfGeoTransform[3] + adfGeoTransform[5]*np.array([HRU_window[1], HRU_window[1] + HRU_window[3]])
+    src_cols, src_rows = (x_edges - srcGeoTransform[0])/srcGeoTransform[1], (y_edges - srcGeoTransform[3])/srcGeoTransform[5]
+    x_start, x_end = int(np.floor(src_cols.min())), int(np.ceil(src_cols.max()))
+    y_start, y_end = int(np.floor(src_rows.min())), int(np.ceil(src_rows.max()))
+    gridGeoTransform = (srcGeoTransform[0] + x_start*srcGeoTransform[1], srcGeoTransform[1], srcGeoTransform[2], 
+                        srcGeoTransform[3] + y_start*srcGeoTransform[5], srcGeoTransform[4], srcGeoTransform[5])
+    
+    return gridGeoTransform, (x_end - x_start, y_end - y_start)
+
+def get_overlap_matrix(srcGeoTransform):
+    # Overlap matrix of a source grid, from memory, disk or computed once and saved. It covers the part of the source grid over
+    # the glacierized HRUs, so all the rasters on that grid share it whatever their extent. Returns the matrix with the
+    # GeoTransform and size of that part of the source grid
+    gdal = load_gdal()
+    HRU_window = get_glacier_HRU_window()
+    grid_key = hashlib.sha256((worker_state['HRU_rasters_hash'] + 'source_grid' + str(get_source_grid_key(srcGeoTransform)) + str(HRU_window)).encode()).hexdigest()
+    if(grid_key not in worker_state['overlap_matrices']):
+        overlap_matrix_file = os.path.join(worker_state['overlap_matrices_path'], grid_key + '.npz')
+        if(os.path.isfile(overlap_matrix_file)):
+            with np.load(overlap_matrix_file) as overlap_matrix:
+                worker_state['overlap_matrices'][grid_key] = (overlap_matrix['src_pixels'], overlap_matrix['dst_pixels'], overlap_matrix['HRUs'], overlap_matrix['weights'], 
+                                                              tuple(overlap_matrix['GeoTransform']), tuple(overlap_matrix['size']))
+        else:
+            raster_HRU = gdal.Open(worker_state['HRU_path'], gdal.GA_ReadOnly)
+            gridGeoTransform, grid_size = get_source_grid_window(srcGeoTransform, raster_HRU.GetGeoTransform(), HRU_window)
+            src_pixels, dst_pixels, HRUs, weights = compute_overlap_matrix(gridGeoTransform, grid_size, raster_HRU, worker_state['HRUs_ID_ice'])
+            os.makedirs(worker_state['overlap_matrices_path'], exist_ok=True)
+            tmp_overlap_matrix_file = os.path.join(worker_state['overlap_matrices_path'], grid_key + '.tmp.npz')
+            np.savez(tmp_overlap_matrix_file, src_pixels=src_pixels, dst_pixels=dst_pixels, HRUs=HRUs, weights=weights, GeoTransform=np.array(gridGeoTransform), size=np.array(grid_size))
+            os.replace(tmp_overlap_matrix_file, overlap_matrix_file)
+            worker_state['overlap_matrices'][grid_key] = (src_pixels, dst_pixels, HRUs, weights, gridGeoTransform, grid_size)
+    
+    return worker_state['overlap_matrices'][grid_key]
+
+def get_source_grid_key(glacierGeoTransform):
+    # Rasters on the same source grid share their resolution and pixel edges (origin modulo the pixel size)
+    return (glacierGeoTransform[1], glacierGeoTransform[2], glacierGeoTransform[4], glacierGeoTransform[5], 
+            round((glacierGeoTransform[0]/glacierGeoTransform[1]) % 1, 6) % 1, round((glacierGeoTransform[3]/glacierGeoTransform[5]) % 1, 6) % 1)
+
+def mosaic_source_grids(year_paths_glacier_thickness):
+    # Ice thickness of all the glaciers of a year merged on each of their source grids, overlapping glaciers summing their
+    # ice on the shared source pixels as in the pixel modes. Returns a (mosaic thickness, GeoTransform) tuple per source grid
+    gdal = load_gdal()
+    source_grids = {}
+    for full_path_glacier_thickness in year_paths_glacier_thickness:
+        raster_glacier = gdal.Open(full_path_glacier_thickness, gdal.GA_ReadOnly)
+        glacierGeoTransform = raster_glacier.GetGeoTransform()
+        source_grids.setdefault(get_source_grid_key(glacierGeoTransform), []).append((raster_glacier, glacierGeoTransform))
+    
+    mosaics = []
+    for grid_rasters_glacier in source_grids.values():
+        refGeoTransform = grid_rasters_glacier[0][1]
+        offsets = [(int(round((glacierGeoTransform[0] - refGeoTransform[0])/refGeoTransform[1])), int(round((glacierGeoTransform[3] - refGeoTransform[3])/refGeoTransform[5]))) 
+                   for raster_glacier, glacierGeoTransform in grid_rasters_glacier]
+        x_min, y_min = min(x_off for x_off, y_off in offsets), min(y_off for x_off, y_off in offsets)
+        x_max = max(x_off + raster_glacier.RasterXSize for (raster_glacier, glacierGeoTransform), (x_off, y_off) in zip(grid_rasters_glacier, offsets))
+        y_max = max(y_off + raster_glacier.RasterYSize for (raster_glacier, glacierGeoTransform), (x_off, y_off) in zip(grid_rasters_glacier, offsets))
+        mosaic_glacier_thickness = np.zeros((y_max - y_min, x_max - x_min))
+        for (raster_glacier, glacierGeoTransform), (x_off, y_off) in zip(grid_rasters_glacier, offsets):
+            paste_aligned_window((x_off - x_min, y_off - y_min, raster_glacier.ReadAsArray()), mosaic_glacier_thickness)
+        mosaicGeoTransform = (refGeoTransform[0] + x_min*refGeoTransform[1], refGeoTransform[1], refGeoTransform[2], 
+                              refGeoTransform[3] + y_min*refGeoTransform[5], refGeoTransform[4], refGeoTransform[5])
+        mosaics.append((mosaic_glacier_thickness, mosaicGeoTransform))
+    
+    return mosaics
+
+def reduce_overlap_glacier_thickness(year_paths_glacier_thickness, i_zonal_statistics=False):
+    # Ice area (in HRU pixels) of each HRU, plus its summed thickness (times the HRU pixel area) and max thickness for the zonal statistics.
+    # The weights of each source grid are applied once to its merged ice, and the ice of glaciers on different source grids is
+    # merged on the HRU grid pixels, none of them being covered more than once
+    n_HRUs = worker_state['HRU_pixel_count'].size
+    HRU_thickness_sum, HRU_max_thickness = np.zeros((2, n_HRUs))
+    ice_dst_pixels, ice_HRUs, ice_areas = [], [], []
+    for mosaic_glacier_thickness, mosaicGeoTransform in mosaic_source_grids(year_paths_glacier_thickness):
+        src_pixels, dst_pixels, HRUs, weights, gridGeoTransform, grid_size = get_overlap_matrix(mosaicGeoTransform)
+        if(src_pixels.size > 0):
+            # The source pixels of the matrix are moved by the offset of the mosaic within the source grid window of the matrix,
+            # those outside the mosaic having no ice
+            x_off = int(round((mosaicGeoTransform[0] - gridGeoTransform[0])/gridGeoTransform[1]))
+            y_off = int(round((mosaicGeoTransform[3] - gridGeoTransform[3])/gridGeoTransform[5]))
+            src_rows, src_cols = np.divmod(src_pixels, grid_size[0])
+            src_rows, src_cols = src_rows - y_off, src_cols - x_off
+            in_mosaic = (src_rows >= 0) & (src_rows < mosaic_glacier_thickness.shape[0]) & (src_cols >= 0) & (src_cols < mosaic_glacier_thickness.shape[1])
+            glacier_thickness = np.zeros(src_pixels.size)
+            glacier_thickness[in_mosaic] = mosaic_glacier_thickness[src_rows[in_mosaic], src_cols[in_mosaic]]
+            glacier_pixels = glacier_thickness > 0
+            ice_dst_pixels.append(dst_pixels[glacier_pixels])
+            ice_HRUs.append(HRUs[glacier_pixels])
+            ice_areas.append(weights[glacier_pixels])
+            if(i_zonal_statistics):
+                HRU_thickness_sum += np.bincount(HRUs, weights=weights*glacier_thickness, minlength=n_HRUs)
+                np.maximum.at(HRU_max_thickness, HRUs, glacier_thickness)
+    
+    if(len(ice_areas) == 0):
+        HRU_ice_area = np.zeros(n_HRUs)
+    elif(len(ice_areas) == 1):
+        HRU_ice_area = np.bincount(ice_HRUs[0], weights=ice_areas[0], minlength=n_HRUs)
+    else:
+        ice_dst_pixels, first_pairs, pair_pixels = np.unique(np.concatenate(ice_dst_pixels), return_index=True, return_inverse=True)
+        ice_pixel_areas = np.minimum(np.bincount(pair_pixels.ravel(), weights=np.concatenate(ice_areas)), 1)
+        HRU_ice_area = np.bincount(np.concatenate(ice_HRUs)[first_pairs], weights=ice_pixel_areas, minlength=n_HRUs)
+    
+    return HRU_ice_area, HRU_thickness_sum, HRU_max_thickness
+
+def compute_overlap_glacier_fractions(year_paths_glacier_thickness):
+    # Sparse matrix-vector products of the overlap weights with the merged ice pixels of the glaciers of each source grid
+    HRU_ice_area, HRU_thickness_sum, HRU_max_thickness = reduce_overlap_glacier_thickness(year_paths_glacier_thickness)
+    
+    # Rounding errors aside, the ice cannot cover more than the whole HRU
+    return np.minimum(HRU_ice_area/worker_state['HRU_pixel_count'], 1)
+
+def compute_overlap_zonal_statistics(year_paths_glacier_thickness):
+    # Zonal statistics from the overlap weights, the thickness of each source pixel counting for the HRU area it overlaps
+    HRU_ice_area, HRU_thickness_sum, HRU_max_thickness = reduce_overlap_glacier_thickness(year_paths_glacier_thickness, i_zonal_statistics=True)
+    HRU_glacier_fractions = np.minimum(HRU_ice_area/worker_state['HRU_pixel_count'], 1)
+    
+    return get_zonal_statistics(HRU_ice_area, HRU_glacier_fractions, HRU_thickness_sum, HRU_max_thickness, worker_state['cell_area'])
+
+def read_proc_status(field):
+    # Memory field of /proc/self/status in bytes (None if not available, e.g. outside Linux)
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if(line.startswith(field + ':')):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    
+    return None
+
+def get_rss():
+    # Current resident set size of the process in bytes (None if it cannot be measured on this platform)
+    rss = read_proc_status('VmRSS')
+    if(rss is None):
+        try:
+            import psutil
+            rss = psutil.Process().memory_info().rss
+        except ImportError:
+            pass
+    
+    return rss
+
+def reset_peak_rss():
+    # Resets the peak RSS of the process to its current RSS (Linux only), returning whether it was reset
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+        return read_proc_status('VmHWM') is not None
+    except OSError:
+        return False
+
+def get_process_peak_rss():
+    # Peak resident set size of the process since it started (or since the last reset_peak_rss) in bytes
+    peak_rss = read_proc_status('VmHWM')
+    if(peak_rss is not None):
+        return peak_rss
+    try:
+        import resource
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_rss if sys.platform == 'darwin' else peak_rss*1024
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset
+        except (ImportError, AttributeError):
+            return None
+
+@contextlib.contextmanager
+def instrument_stage(stage_records, stage, year=None, **counters):
+    # Records the wall time, CPU time and RSS at the start and end of a stage plus its peak RSS (no-op if stage_records is None).
+    # Where the peak cannot be reset per stage, peak_rss is None and only the peak of the process since it started is recorded
+    if(stage_records is None):
+        yield counters
+        return
+    with active_stages['lock']:
+        peak_rss_reset = active_stages['count'] > 0 or reset_peak_rss()
+        active_stages['count'] += 1
+    rss_start = get_rss()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield counters
+    finally:
+        with active_stages['lock']:
+            active_stages['count'] -= 1
+    wall_time, cpu_time, rss_end = time.perf_counter() - wall_start, time.process_time() - cpu_start, get_rss()
+    process_peak_rss = get_process_peak_rss()
+    stage_records.append(dict({'stage': stage, 'year': year, 'wall_time': wall_time, 'cpu_time': cpu_time, 
+                               'rss_start': rss_start, 'rss_end': rss_end, 'peak_rss': process_peak_rss if peak_rss_reset else None, 
+                               'process_peak_rss': process_peak_rss, 'pid': os.getpid()}, **counters))
+
+def summarize_run_report(stage_records, counters, config):
+    # Per stage totals of the records, the run counters and configuration
+    stage_totals = {}
+    for stage_record in stage_records:
+        stage_total = stage_totals.setdefault(stage_record['stage'], {'calls': 0, 'wall_time': 0., 'cpu_time': 0., 'peak_rss': None, 'max_rss_increase': None})
+        stage_total['calls'] += 1
+        stage_total['wall_time'] += stage_record['wall_time']
+        stage_total['cpu_time'] += stage_record['cpu_time']
+        if(stage_record['peak_rss'] is not None):
+            stage_total['peak_rss'] = max(stage_total['peak_rss'] or 0, stage_record['peak_rss'])
+        if(stage_record['rss_start'] is not None and stage_record['rss_end'] is not None):
+            stage_total['max_rss_increase'] = max(stage_total['max_rss_increase'] or 0, stage_record['rss_end'] - stage_record['rss_start'])
+    # Labelled pixels reduced per HRU, and HRU raster pixels indexed to find them
+    counters['pixels_scanned'] = int(sum(stage_record.get('pixels', 0) for stage_record in stage_records))
+    counters['pixels_indexed'] = int(sum(stage_record.get('indexed_pixels', 0) for stage_record in stage_records))
+    
+    return {'config': config, 'counters': counters, 'stage_totals': stage_totals, 'stages': stage_records}
+
+def init_glacier_fractions_worker(landuse_path, i_alignment_mode, i_aligned_glacier_thickness_path, i_glacier_HRU_pixels, i_glacier_HRU_labels, i_HRU_pixel_count, i_HRU_tiles=None, 
+                                  HRU_path=None, i_HRUs_ID_ice=None, i_overlap_matrices_path=None, HRU_rasters_hash=None, instrumentation=False, i_compute_backend='numpy', 
+                                  i_zonal_statistics=False):
+    # Each worker process keeps its own HRU grid description and aligned thickness buffer. Only the GeoTransform and size
+    # of the land use grid are kept, so the prefetch threads never share its GDAL dataset
+    global worker_state
+    gdal = load_gdal()
+    set_compute_backend(i_compute_backend)
+    raster_HRU_landuse = gdal.Open(landuse_path, gdal.GA_ReadOnly)
+    landuse_GeoTransform = raster_HRU_landuse.GetGeoTransform(can_return_null = True)
+    worker_state = {'landuse_GeoTransform': landuse_GeoTransform,
+                    'landuse_size': (raster_HRU_landuse.RasterXSize, raster_HRU_landuse.RasterYSize),
+                    'aligned_glacier_thickness': None,
+                    'alignment_mode': i_alignment_mode,
+                    'aligned_glacier_thickness_path': i_aligned_glacier_thickness_path,
+                    'glacier_HRU_pixels': i_glacier_HRU_pixels,
+                    'glacier_HRU_labels': i_glacier_HRU_labels,
+                    'glacier_HRU_offsets': get_HRU_offsets(i_HRU_pixel_count) if i_glacier_HRU_pixels is not None else None,
+                    'HRU_pixel_count': i_HRU_pixel_count,
+                    'HRU_tiles': i_HRU_tiles,
+                    'raster_HRU': gdal.Open(HRU_path, gdal.GA_ReadOnly) if i_HRU_tiles is not None else None,
+                    'HRU_path': HRU_path,
+                    'HRUs_ID_ice': i_HRUs_ID_ice,
+                    'overlap_matrices_path': i_overlap_matrices_path,
+                    'HRU_rasters_hash': HRU_rasters_hash,
+                    'overlap_matrices': {},
+                    'zonal_statistics': i_zonal_statistics,
+                    'cell_area': abs(landuse_GeoTransform[1]*landuse_GeoTransform[5]),
+                    'stage_records': [] if instrumentation else None}
+    
+    # Tiled and overlap runs never hold a full grid
+    if(i_HRU_tiles is None and i_alignment_mode != 'overlap'):
+        worker_state['aligned_glacier_thickness'] = np.zeros((worker_state['landuse_size'][1], worker_state['landuse_size'][0]), dtype=np.float64)
+
+def read_year_glacier_thickness(year_paths_glacier_thickness):
+    # Raster I/O of a year: the part of each glacier overlapping the HRU grid, read in a background thread when prefetching
+    year = int(year_paths_glacier_thickness[0][-8:-4])
+    grid_rows, grid_cols = worker_state['aligned_glacier_thickness'].shape
+    read_records = [] if worker_state['stage_records'] is not None else None
+    with instrument_stage(read_records, 'read', year, glaciers=len(year_paths_glacier_thickness)):
+        aligned_rasters_glacier = [open_aligned_raster(full_path_glacier_thickness) for full_path_glacier_thickness in year_paths_glacier_thickness]
+        glacier_windows = [read_aligned_window(raster_glacier, x_off, y_off, (0, 0, grid_cols, grid_rows)) for raster_glacier, x_off, y_off in aligned_rasters_glacier]
+    
+    return [glacier_window for glacier_window in glacier_windows if glacier_window is not None], read_records
+
+def prefetch_glacier_thickness(list_year_paths_glacier_thickness, i_n_prefetch):
+    # Yields (year paths, glacier windows, read stage records) in order, with the next i_n_prefetch years read in background threads.
+    # The read of a year is submitted before the oldest pending year is yielded, so i_n_prefetch reads run while the
+    # consumer computes it, and at most i_n_prefetch years wait in memory besides the one being computed
+    with concurrent.futures.ThreadPoolExecutor(i_n_prefetch) as executor:
+        pending_years = collections.deque()
+        for year_paths_glacier_thickness in list_year_paths_glacier_thickness:
+            pending_years.append((year_paths_glacier_thickness, executor.submit(read_year_glacier_thickness, year_paths_glacier_thickness)))
+            if(len(pending_years) > i_n_prefetch):
+                pending_year_paths, year_read = pending_years.popleft()
+                yield (pending_year_paths,) + year_read.result()
+        while(pending_years):
+            pending_year_paths, year_read = pending_years.popleft()
+            yield (pending_year_paths,) + year_read.result()
+
+def reduce_aligned_glacier_thickness(aligned_glacier_thickness):
+    # Glacier fraction vector of the aligned thickness grid, or zonal statistics matrix if the worker computes them
+    if(worker_state['zonal_statistics']):
+        return compute_zonal_statistics(aligned_glacier_thickness, worker_state['glacier_HRU_pixels'], worker_state['glacier_HRU_labels'], 
+                                        worker_state['glacier_HRU_offsets'], worker_state['HRU_pixel_count'], worker_state['cell_area'])
+    
+    return compute_glacier_fractions(aligned_glacier_thickness, worker_state['glacier_HRU_pixels'], worker_state['glacier_HRU_labels'], worker_state['HRU_pixel_count'])
+
+def compute_prefetched_glacier_fractions_records(year_paths_glacier_thickness, glacier_windows, read_records):
+    # Glacier fractions of a year from its prefetched glacier windows, with the stage records (including the read in the background)
+    year = int(year_paths_glacier_thickness[0][-8:-4])
+    stage_records = worker_state['stage_records']
+    if(stage_records is not None):
+        stage_records.extend(read_records)
+    with instrument_stage(stage_records, 'alignment', year):
+        aligned_glacier_thickness = worker_state['aligned_glacier_thickness']
+        aligned_glacier_thickness.fill(0)
+        for glacier_window in glacier_windows:
+            paste_aligned_window(glacier_window, aligned_glacier_thickness)
+    
+    with instrument_stage(stage_records, 'reduction', year, pixels=worker_state['glacier_HRU_pixels'].size):
+        HRU_glacier_fractions = reduce_aligned_glacier_thickness(aligned_glacier_thickness)
+    if(stage_records is not None):
+        worker_state['stage_records'] = []
+    
+    return HRU_glacier_fractions, stage_records
+
+def compute_year_glacier_fractions(year_paths_glacier_thickness):
+    # Align the glacier ice thickness rasters of all the glaciers of a year and reduce them at once to the glacierized fraction of each HRU
+    # (or to the zonal statistics matrix, glacier fractions included, if the worker computes them)
+    year = int(year_paths_glacier_thickness[0][-8:-4])
+    stage_records = worker_state['stage_records']
+    
+    if(worker_state['alignment_mode'] == 'overlap'):
+        with instrument_stage(stage_records, 'overlap_reduction', year):
+            if(worker_state['zonal_statistics']):
+                return compute_overlap_zonal_statistics(year_paths_glacier_thickness)
+            return compute_overlap_glacier_fractions(year_paths_glacier_thickness)
+    
+    with instrument_stage(stage_records, 'alignment', year, glaciers=len(year_paths_glacier_thickness)):
+        aligned_rasters_glacier = [open_aligned_raster(full_path_glacier_thickness) for full_path_glacier_thickness in year_paths_glacier_thickness]
+    
+    if(worker_state['HRU_tiles'] is not None):
+        # Only the tiles with ice are indexed and reduced
+        with instrument_stage(stage_records, 'tiled_alignment_reduction', year, pixels=0, indexed_pixels=0) as stage_counters:
+            if(worker_state['zonal_statistics']):
+                return compute_tiled_zonal_statistics(aligned_rasters_glacier, worker_state['HRU_tiles'], worker_state['raster_HRU'], worker_state['HRUs_ID_ice'], 
+                                                      worker_state['HRU_pixel_count'], worker_state['cell_area'], stage_counters)
+            return compute_tiled_glacier_fractions(aligned_rasters_glacier, worker_state['HRU_tiles'], worker_state['raster_HRU'], worker_state['HRUs_ID_ice'], worker_state['HRU_pixel_count'], 
+                                                   stage_counters)
+    
+    # Only the window of each glacier is added to the HRU grid, overlapping glaciers sum their ice
+    with instrument_stage(stage_records, 'alignment', year):
+        aligned_glacier_thickness = worker_state['aligned_glacier_thickness']
+        grid_rows, grid_cols = aligned_glacier_thickness.shape
+        aligned_glacier_thickness.fill(0)
+        for raster_glacier, x_off, y_off in aligned_rasters_glacier:
+            accumulate_aligned_window(raster_glacier, x_off, y_off, (0, 0, grid_cols, grid_rows), aligned_glacier_thickness)
+    
+    with instrument_stage(stage_records, 'reduction', year, pixels=worker_state['glacier_HRU_pixels'].size):
+        return reduce_aligned_glacier_thickness(aligned_glacier_thickness)
+
+def compute_year_glacier_fractions_records(year_paths_glacier_thickness):
+    # Glacier fractions of a year with the stage records of the worker, which may live in another process
+    HRU_glacier_fractions = compute_year_glacier_fractions(year_paths_glacier_thickness)
+    stage_records = worker_state['stage_records']
+    if(stage_records is not None):
+        worker_state['stage_records'] = []
+    
+    return HRU_glacier_fractions, stage_records
+
+def write_dat_header(dat_file, HRUs_ID_ice):
+    dat_file.write(' '.join(['date'] + [str(int(HRU_ID)) for HRU_ID in HRUs_ID_ice]) + '\n')
+
+def write_dat_rows(dat_file, daily_glacier_fractions, daily_dates, precision=None, chunk_size=1000):
+    # Rows of the space separated .dat file, formatted in chunks
+    if(precision is None):
+        value_format = '%r'
+    else:
+        value_format = '%.' + str(int(precision)) + 'f'
+    row_format = '%s ' + ' '.join([value_format]*daily_glacier_fractions.shape[1]) + '\n'
+    dates = daily_dates.strftime('%Y-%m-%d')
+    
+    for chunk_start in range(0, dates.size, chunk_size):
+        chunk_rows = daily_glacier_fractions[chunk_start:chunk_start + chunk_size].tolist()
+        dat_file.write(''.join([row_format % ((date,) + tuple(row)) for date, row in zip(dates[chunk_start:chunk_start + chunk_size], chunk_rows)]))
+
+def write_dat(daily_glacier_fractions, daily_dates, HRUs_ID_ice, dat_path, precision=None, chunk_size=1000):
+    # Space separated .dat file read by J2K
+    with open(dat_path, 'w', newline='\n') as dat_file:
+        write_dat_header(dat_file, HRUs_ID_ice)
+        write_dat_rows(dat_file, daily_glacier_fractions, daily_dates, precision, chunk_size)
+
+def write_npy_index(daily_dates, HRUs_ID_ice, output_path):
+    np.savez(output_path + '_index.npz', dates=daily_dates.values.astype('datetime64[D]'), HRU_IDs=HRUs_ID_ice.astype(np.int64))
+
+def write_npy(daily_glacier_fractions, daily_dates, HRUs_ID_ice, output_path):
+    # Memory-mappable daily matrix with its date and HRU ID index arrays
+    np.save(output_path + '.npy', daily_glacier_fractions)
+    write_npy_index(daily_dates, HRUs_ID_ice, output_path)
+
+def load_npy(output_path):
+    # Zero-copy access to the daily glacier fractions written by write_npy
+    daily_glacier_fractions = np.load(output_path + '.npy', mmap_mode='r')
+    with np.load(output_path + '_index.npz') as output_index:
+        daily_dates, HRUs_ID_ice = output_index['dates'], output_index['HRU_IDs']
+    
+    return daily_glacier_fractions, daily_dates, HRUs_ID_ice
+
+def write_parquet(daily_HRU_glacier_evolution_df, output_path):
+    try:
+        daily_HRU_glacier_evolution_df.to_parquet(output_path + '.parquet')
+    except ImportError:
+        print("\nParquet output skipped: pyarrow or fastparquet is not installed")
+
+def hash_file(file_path, chunk_size=2**20):
+    # SHA-256 of the file content
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    
+    return file_hash.hexdigest()
+
+def get_cache_key(HRU_rasters_hash, year_paths_glacier_thickness, i_alignment_mode, i_zonal_statistics=False):
+    # Cache key of a year from the HRU rasters and the content of all its glacier ice thickness files.
+    # Zonal statistics matrices are cached under their own keys, next to the glacier fraction vectors
+    cache_key = hashlib.sha256((HRU_rasters_hash + i_alignment_mode + ('zonal_statistics' if i_zonal_statistics else '')).encode())
+    for full_path_glacier_thickness in sorted(year_paths_glacier_thickness):
+        cache_key.update(hash_file(full_path_glacier_thickness).encode())
+    
+    return cache_key.hexdigest()
+
+def load_cached_fractions(cache_path, cache_key):
+    cache_file = os.path.join(cache_path, cache_key + '.npy')
+    if(not os.path.isfile(cache_file)):
+        return None
+    
+    # Mark the entry as recently used for the eviction
+    os.utime(cache_file)
+    
+    return np.load(cache_file)
+
+def save_cached_fractions(cache_path, cache_key, HRU_glacier_fractions):
+    os.makedirs(cache_path, exist_ok=True)
+    tmp_cache_file = os.path.join(cache_path, cache_key + '.tmp.npy')
+    np.save(tmp_cache_file, HRU_glacier_fractions)
+    os.replace(tmp_cache_file, os.path.join(cache_path, cache_key + '.npy'))
+
+def evict_cache(cache_path, i_max_cache_size):
+    # Remove the least recently used entries until the cache fits in i_max_cache_size bytes
+    if(not os.path.isdir(cache_path)):
+        return
+    cache_files = sorted((entry for entry in os.scandir(cache_path) if entry.name.endswith('.npy')), key=lambda entry: entry.stat().st_mtime)
+    cache_size = sum(entry.stat().st_size for entry in cache_files)
+    for entry in cache_files:
+        if(cache_size <= i_max_cache_size):
+            break
+        cache_size = cache_size - entry.stat().st_size
+        os.remove(entry.path)
+
+def clear_cache(cache_path):
+    if(os.path.isdir(cache_path)):
+        for entry in os.scandir(cache_path):
+            if(entry.name.endswith('.npy')):
+                os.remove(entry.path)
+    print("\nCleared glacier fractions cache: " + str(cache_path))
+
+def generate_annual_glacier_fractions(list_year_paths_glacier_thickness, worker_args, i_n_workers=1, cache_keys=None, cache_path=None, stage_records=None, i_n_prefetch=0):
+    # Yields the glacier fraction vector of each year in order, from the cache or computed (across a process pool if i_n_workers > 1,
+    # or prefetching the rasters of the next i_n_prefetch years in serial runs of the untiled in_memory and vrt modes).
+    # The stage records of the workers are added to stage_records if it is not None
+    if(cache_keys is None):
+        cache_keys = [None]*len(list_year_paths_glacier_thickness)
+    is_cached = [cache_key is not None and os.path.isfile(os.path.join(cache_path, cache_key + '.npy')) for cache_key in cache_keys]
+    missing_year_paths_glacier_thickness = [year_paths_glacier_thickness for year_paths_glacier_thickness, year_is_cached in zip(list_year_paths_glacier_thickness, is_cached) if not year_is_cached]
+    print("\nYears computed: " + str(len(missing_year_paths_glacier_thickness)) + " / " + str(len(list_year_paths_glacier_thickness)))
+    
+    def merge_cached_fractions(computed_HRU_glacier_fractions):
+        for cache_key, year_is_cached in zip(cache_keys, is_cached):
+            if(year_is_cached):
+                yield load_cached_fractions(cache_path, cache_key)
             else:
-                daily_HRU_glacier_evolution_df = current_column
-                start_joining = True
+                HRU_glacier_fractions, year_stage_records = next(computed_HRU_glacier_fractions)
+                if(stage_records is not None and year_stage_records is not None):
+                    stage_records.extend(year_stage_records)
+                if(cache_key is not None):
+                    save_cached_fractions(cache_path, cache_key, HRU_glacier_fractions)
+                yield HRU_glacier_fractions
     
-    return daily_HRU_glacier_evolution_df
+    # Years are independent at this stage, so they can be processed in parallel. Workers are spawned rather than
+    # forked with the numba backend, as the OpenMP/TBB threads of its kernels in this process are not fork-safe
+    if(i_n_workers > 1 and len(missing_year_paths_glacier_thickness) > 1):
+        pool_context = multiprocessing.get_context('spawn' if numba_kernels is not None else None)
+        with pool_context.Pool(i_n_workers, initializer=init_glacier_fractions_worker, initargs=worker_args) as pool:
+            yield from merge_cached_fractions(pool.imap(compute_year_glacier_fractions_records, missing_year_paths_glacier_thickness))
+    else:
+        computed_HRU_glacier_fractions = map(compute_year_glacier_fractions_records, missing_year_paths_glacier_thickness)
+        if(len(missing_year_paths_glacier_thickness) > 0):
+            init_glacier_fractions_worker(*worker_args)
+            if(i_n_prefetch > 0 and worker_state['aligned_glacier_thickness'] is not None):
+                computed_HRU_glacier_fractions = (compute_prefetched_glacier_fractions_records(*prefetched_year) 
+                                                  for prefetched_year in prefetch_glacier_thickness(missing_year_paths_glacier_thickness, i_n_prefetch))
+        yield from merge_cached_fractions(computed_HRU_glacier_fractions)
 
+def create_annual_store(years, HRUs_ID_ice, dtype=np.float64, i_zonal_statistics=False):
+    # Preallocated (years x HRUs) matrix of the annual glacier fractions, indexed by year and integer HRU ID,
+    # with a (statistics x years x HRUs) matrix of the annual zonal statistics if they are computed
+    return {'years': np.asarray(years, dtype=np.int64),
+            'HRU_IDs': np.asarray(HRUs_ID_ice, dtype=np.int64),
+            'year_rows': {int(year): row for row, year in enumerate(years)},
+            'HRU_columns': {int(HRU_ID): column for column, HRU_ID in enumerate(HRUs_ID_ice)},
+            'fractions': np.full((len(years), len(HRUs_ID_ice)), np.nan, dtype=dtype),
+            'zonal_statistics': np.full((len(zonal_statistic_names), len(years), len(HRUs_ID_ice)), np.nan, dtype=dtype) if i_zonal_statistics else None}
 
-###############################################################################
-###                           MAIN                                          ###
-###############################################################################
+def set_annual_fractions(annual_store, year, HRU_glacier_fractions):
+    annual_store['fractions'][annual_store['year_rows'][int(year)]] = HRU_glacier_fractions
 
+def set_annual_zonal_statistics(annual_store, year, HRU_zonal_statistics):
+    annual_store['zonal_statistics'][:, annual_store['year_rows'][int(year)]] = HRU_zonal_statistics
 
-#### Open HRU raster data ###
-raster_HRU = gdal.Open(hru_path + 'hru_cat.tif', gdal.GA_ReadOnly) 
-HRUs = raster_HRU.ReadAsArray()
-raster_HRU_landuse = gdal.Open(hru_path + 'hru_landuse.tif', gdal.GA_ReadOnly) 
-landuse_HRU = raster_HRU_landuse.ReadAsArray()
+def get_annual_zonal_statistic(annual_store, statistic):
+    # Annual values (years x HRUs) of one of the zonal statistics
+    return annual_store['zonal_statistics'][zonal_statistic_names.index(statistic)]
 
-# Land use #7 = ice
-HRU_ice_idx = np.where(landuse_HRU == 7)
-HRUs_ID_ice = np.unique(HRUs[HRU_ice_idx])
+def get_annual_fractions(annual_store, year, HRU_ID=None):
+    # Glacier fractions of all HRUs (view of the matrix row) or of a single HRU for a year
+    if(HRU_ID is None):
+        return annual_store['fractions'][annual_store['year_rows'][int(year)]]
+    
+    return annual_store['fractions'][annual_store['year_rows'][int(year)], annual_store['HRU_columns'][int(HRU_ID)]]
 
-raw_HRU_glacier_evolution = ['year']
-columns = ['date']
-for HRU_ID in HRUs_ID_ice:
-    raw_HRU_glacier_evolution.append(int(HRU_ID))
-    columns.append(str(int(HRU_ID)))    
+def get_previous_annual_fractions(annual_store, year):
+    # Glacier fractions of the year before, None for the first year
+    row = annual_store['year_rows'][int(year)]
+    
+    return annual_store['fractions'][row - 1] if row > 0 else None
 
-isFirst, initDF = True, True
+def get_annual_dataframe(annual_store, statistic=None):
+    # Annual glacier fractions (or zonal statistic) with the years as index and the HRU IDs as columns
+    annual_values = annual_store['fractions'] if statistic is None else get_annual_zonal_statistic(annual_store, statistic)
+    
+    return pd.DataFrame(annual_values, index=pd.Index(annual_store['years'], name='year'), columns=annual_store['HRU_IDs'], copy=False)
 
+def generate_daily_glacier_fractions(years, annual_glacier_fractions, annual_store, i_ablation_start=(6, 1), stage_records=None):
+    # Yields (year, annual fractions, hydrological year dates, daily fractions) as soon as each year is ready, storing the
+    # annual fractions in annual_store. The first year has no daily fractions since there is nothing to interpolate from
+    for year, HRU_glacier_fractions in zip(years, annual_glacier_fractions):
+        # Zonal statistics matrices hold the glacier fractions in one of their rows
+        if(HRU_glacier_fractions.ndim == 2):
+            set_annual_zonal_statistics(annual_store, year, HRU_glacier_fractions)
+            HRU_glacier_fractions = HRU_glacier_fractions[zonal_statistic_names.index('fraction')]
+        set_annual_fractions(annual_store, year, HRU_glacier_fractions)
+        HRU_glacier_fractions = get_annual_fractions(annual_store, year)
+        previous_HRU_glacier_fractions = get_previous_annual_fractions(annual_store, year)
+        
+        hydro_year_range = get_hydro_year_range(year)
+        if(previous_HRU_glacier_fractions is None):
+            daily_glacier_fractions = None
+        else:
+            with instrument_stage(stage_records, 'interpolation', year, days=hydro_year_range.size):
+                daily_glacier_fractions = interpolate_glacier_fractions(hydro_year_range, previous_HRU_glacier_fractions, HRU_glacier_fractions, year, i_ablation_start)
+        
+        yield year, HRU_glacier_fractions, hydro_year_range, daily_glacier_fractions
+
+def write_daily_zonal_statistics(zonal_statistics_files, annual_store, year, hydro_year_range, i_ablation_start=(6, 1), precision=None, chunk_size=1000):
+    # Appends the daily values of the hydrological year of each selected zonal statistic to its open .dat file,
+    # interpolated between the annual values of the year before and the current one as the glacier fractions
+    row = annual_store['year_rows'][int(year)]
+    for statistic, dat_file in zonal_statistics_files.items():
+        annual_statistic = get_annual_zonal_statistic(annual_store, statistic)
+        daily_statistic = interpolate_glacier_fractions(hydro_year_range, annual_statistic[row - 1], annual_statistic[row], year, i_ablation_start)
+        write_dat_rows(dat_file, daily_statistic, hydro_year_range, precision, chunk_size)
 
-######## Iterate all years of glacier evolution data   ###########
+def get_hydro_year_range(year):
+    # Dates of the hydrological year with a daily timestep
+    return pd.date_range(start=str(year-1) + '-10-01', end=str(year) + '-09-30')
 
-for path_glacier_thickness in list_path_glacier_thickness:
-   
-    full_path_glacier_thickness = original_glacier_thickness_path + path_glacier_thickness
-#    print("\nGlacier ice thickness file: " + str(full_path_glacier_thickness))
+def initialize_dataframe(daily_glacier_fractions, daily_dates, HRUs_ID_ice):
+    # Wrap the full preallocated daily matrix in a dataframe only once
+    print("\nInitializing dataframe")
+    daily_HRU_glacier_evolution_df = pd.DataFrame(data=daily_glacier_fractions, index=daily_dates, 
+                                                  columns=[str(int(HRU_ID)) for HRU_ID in HRUs_ID_ice], copy=False)
     
-    glacier_ID = path_glacier_thickness[-14:-9]
-    year = path_glacier_thickness[-8:-4]
+    return daily_HRU_glacier_evolution_df
+
+
+###############################################################################
+###                           MAIN                                          ###
+###############################################################################
+
+
+def run_glacier_hru_evolution(hru_path, original_glacier_thickness_path, hru_glacier_fractions_path, aligned_glacier_thickness_path=None, 
+                              overlap_matrices_path=None, glacier_fractions_cache_path=None, alignment_mode=alignment_mode, tiled=tiled, 
+                              min_tile_size=min_tile_size, n_workers=n_workers, n_prefetch=n_prefetch, use_cache=use_cache, max_cache_size=max_cache_size, 
+                              output_formats=output_formats, dat_writer=dat_writer, dat_precision=dat_precision, dat_chunk_size=dat_chunk_size, 
+                              streaming=streaming, write_run_report=write_run_report, profile_run=profile_run, ablation_start=ablation_start, 
+                              compute_backend=compute_backend, zonal_statistics=zonal_statistics, zonal_statistics_frequency=zonal_statistics_frequency):
+    # Computes the daily glacier fractions of the glacierized HRUs of a catchment and writes them to hru_glacier_fractions_path.
+    # All paths are explicit and nothing is kept between calls, so a single long-lived process can run many catchments.
+    # The intermediate folders default to subfolders of the glacier thickness folder.
+    # Returns a dictionary with the output path, the years, the glacierized HRU IDs, the run report (or None), the
+    # annual glacier fractions dataframe, the daily one (None in streaming mode) and the paths and annual dataframes of the zonal statistics
+    gdal = load_gdal()
+    intermediate_paths = get_intermediate_paths(original_glacier_thickness_path)
+    if(aligned_glacier_thickness_path is None):
+        aligned_glacier_thickness_path = intermediate_paths['aligned_glacier_thickness_path']
+    if(overlap_matrices_path is None):
+        overlap_matrices_path = intermediate_paths['overlap_matrices_path']
+    if(glacier_fractions_cache_path is None):
+        glacier_fractions_cache_path = intermediate_paths['glacier_fractions_cache_path']
+    
+    compute_backend = set_compute_backend(compute_backend)
     
-    # Align the current glacier ice thickness raster to the baseline HRU raster
-    current_glacier_thickness = align_rasters(raster_HRU_landuse, full_path_glacier_thickness, aligned_glacier_thickness_path)
+    # Daemonic processes (e.g. process pool workers) cannot start their own pool
+    if(n_workers > 1 and multiprocessing.current_process().daemon):
+        n_workers = 1
     
-    ice_mask = np.where(current_glacier_thickness > 0)
-    current_year = [year]
+    # Instrumentation of the run
+    stage_records = [] if write_run_report else None
+    if(profile_run):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    
+    # List of paths to glacier ice thickness raster data
+    list_path_glacier_thickness = np.asarray(sorted(os.listdir(original_glacier_thickness_path)))
+    
+    #### Open HRU raster data ###
+    raster_HRU = gdal.Open(os.path.join(hru_path, 'hru_cat.tif'), gdal.GA_ReadOnly) 
+    raster_HRU_landuse = gdal.Open(os.path.join(hru_path, 'hru_landuse.tif'), gdal.GA_ReadOnly) 
+    
+    # The HRU layout does not change over time, so the pixel labels are only indexed once
+    with instrument_stage(stage_records, 'HRU_indexing', indexed_pixels=raster_HRU.RasterXSize*raster_HRU.RasterYSize):
+        if(tiled):
+            HRUs_ID_ice, HRU_tiles, HRU_pixel_count = index_HRU_tiles(raster_HRU, raster_HRU_landuse, min_tile_size)
+            glacier_HRU_pixels, glacier_HRU_labels = None, None
+        else:
+            HRUs = raster_HRU.ReadAsArray()
+            landuse_HRU = raster_HRU_landuse.ReadAsArray()
+            
+            # Land use #7 = ice
+            HRU_ice_idx = np.where(landuse_HRU == 7)
+            HRUs_ID_ice = np.unique(HRUs[HRU_ice_idx])
+            
+            glacier_HRU_pixels, glacier_HRU_labels, HRU_pixel_count = index_HRU_pixels(HRUs, HRUs_ID_ice)
+            HRU_tiles = None
+    raster_HRU, raster_HRU_landuse = None, None
     
-    # We create the dates of the hydrological year with an annual timestep
-    year = int(year)
-    print("\nYear: " + str(year))
-    hydro_year_range = pd.date_range(start=str(year-1) + '-10-01', end=str(year) + '-09-30')
-    interp_annual_ice_fraction = []
+    ######## Align and reduce all years of glacier evolution data   ###########
     
-    ########   We compute the glaciarized fraction for each HRU with ice   ###########
+    # Glacier ice thickness files of all glaciers (IceDepth_Glacier_<ID>_<year>.tif) grouped by year
+    glacier_thickness_years = {}
+    for path_glacier_thickness in list_path_glacier_thickness:
+        glacier_thickness_years.setdefault(int(path_glacier_thickness[-8:-4]), []).append(os.path.join(original_glacier_thickness_path, path_glacier_thickness))
+    years = sorted(glacier_thickness_years)
+    list_year_paths_glacier_thickness = [glacier_thickness_years[year] for year in years]
     
-    hru_idx = 0
-    for HRU_ID in HRUs_ID_ice:
-        glacier_HRU_idx = np.where(HRUs == HRU_ID)
-        current_thickness_HRU = current_glacier_thickness[glacier_HRU_idx]
-        glacierized_perc_HRU = current_thickness_HRU[current_thickness_HRU > 0].size/HRUs[glacier_HRU_idx].size
+    # Only the years not found in the cache are computed
+    HRU_rasters_hash, cache_keys = None, None
+    if(use_cache or alignment_mode == 'overlap'):
+        HRU_rasters_hash = hash_file(os.path.join(hru_path, 'hru_cat.tif')) + hash_file(os.path.join(hru_path, 'hru_landuse.tif'))
+    if(use_cache):
+        cache_keys = [get_cache_key(HRU_rasters_hash, year_paths_glacier_thickness, alignment_mode, len(zonal_statistics) > 0) for year_paths_glacier_thickness in list_year_paths_glacier_thickness]
+    
+    worker_args = (os.path.join(hru_path, 'hru_landuse.tif'), alignment_mode, aligned_glacier_thickness_path, glacier_HRU_pixels, glacier_HRU_labels, HRU_pixel_count, HRU_tiles, 
+                   os.path.join(hru_path, 'hru_cat.tif'), HRUs_ID_ice, overlap_matrices_path, HRU_rasters_hash, write_run_report, compute_backend, 
+                   len(zonal_statistics) > 0)
+    
+    annual_HRU_glacier_fractions = generate_annual_glacier_fractions(list_year_paths_glacier_thickness, worker_args, n_workers, cache_keys, glacier_fractions_cache_path, stage_records, n_prefetch)
+    annual_store = create_annual_store(years, HRUs_ID_ice, i_zonal_statistics=len(zonal_statistics) > 0)
+    daily_HRU_glacier_fractions = generate_daily_glacier_fractions(years, annual_HRU_glacier_fractions, annual_store, ablation_start, stage_records)
+    
+    daily_dates = pd.DatetimeIndex(np.concatenate([get_hydro_year_range(year).values for year in years[1:]]))
+    output_path = os.path.join(hru_glacier_fractions_path, "HRU_glacier_fractions_" + str(years[0]) + "_" + str(years[-1]))
+    day_idx = 0
+    daily_HRU_glacier_evolution_df = None
+    
+    # Each selected zonal statistic has its own .dat file, filled year by year with the daily values
+    zonal_statistics_paths = {statistic: os.path.join(hru_glacier_fractions_path, "HRU_glacier_" + statistic + "_" + str(years[0]) + "_" + str(years[-1]) + '.dat') 
+                              for statistic in zonal_statistics}
+    zonal_statistics_files = {}
+    if(zonal_statistics_frequency == 'daily'):
+        for statistic, zonal_statistic_path in zonal_statistics_paths.items():
+            zonal_statistics_files[statistic] = open(zonal_statistic_path, 'w', newline='\n')
+            write_dat_header(zonal_statistics_files[statistic], HRUs_ID_ice)
+    
+    if(streaming):
+        
+        ######## Stream all years of glacier evolution data to the output files   ###########
+        
+        if('dat' in output_formats):
+            dat_file = open(output_path + '.dat', 'w', newline='\n')
+            write_dat_header(dat_file, HRUs_ID_ice)
+        if('npy' in output_formats):
+            write_npy_index(daily_dates, HRUs_ID_ice, output_path)
+            daily_glacier_fractions_npy = np.lib.format.open_memmap(output_path + '.npy', mode='w+', dtype=np.float64, shape=(daily_dates.size, HRUs_ID_ice.size))
+        if('parquet' in output_formats):
+            print("\nParquet output skipped: not available in streaming mode")
+        
+        for year, HRU_glacier_fractions, hydro_year_range, daily_glacier_fractions in daily_HRU_glacier_fractions:
+            print("\nYear: " + str(year))
+            if(daily_glacier_fractions is None):
+                continue
+            
+            with instrument_stage(stage_records, 'write', year, days=hydro_year_range.size):
+                if('dat' in output_formats):
+                    write_dat_rows(dat_file, daily_glacier_fractions, hydro_year_range, dat_precision, dat_chunk_size)
+                if('npy' in output_formats):
+                    daily_glacier_fractions_npy[day_idx:day_idx + hydro_year_range.size] = daily_glacier_fractions
+                write_daily_zonal_statistics(zonal_statistics_files, annual_store, year, hydro_year_range, ablation_start, dat_precision, dat_chunk_size)
+            day_idx = day_idx + hydro_year_range.size
+        
+        if('dat' in output_formats):
+            dat_file.close()
+        if('npy' in output_formats):
+            daily_glacier_fractions_npy.flush()
+            del daily_glacier_fractions_npy
+        
+        print("\nStreamed glacierized HRUs daily evolution: " + str(day_idx) + " days x " + str(HRUs_ID_ice.size) + " HRUs")
+        
+    else:
         
-        # We create a new row to be stacked on the raw data
-        current_year.append(glacierized_perc_HRU)
+        # The daily glacier fractions of all the hydrological years are stored in a single preallocated matrix
+        daily_glacier_fractions = np.empty((daily_dates.size, HRUs_ID_ice.size))
         
-        if(not isFirst):
-            # Move from annual to daily resolution
-            current_HRU_ice_fraction = interpolate_glacier_fractions(hydro_year_range, hru_idx)
+        ######## Interpolate all years of glacier evolution data   ###########
+        
+        for year, HRU_glacier_fractions, hydro_year_range, year_daily_glacier_fractions in daily_HRU_glacier_fractions:
             
-            # We add the current HRU's interpolated data to all the data from this year
-            current_HRU_ice_fraction = np.asarray(current_HRU_ice_fraction)
-            interp_annual_ice_fraction.append(current_HRU_ice_fraction)
+            print("\nYear: " + str(year))
             
-        hru_idx=hru_idx+1
+            # We fill the current year's block of the full daily matrix
+            if(year_daily_glacier_fractions is not None):
+                daily_glacier_fractions[day_idx:day_idx + hydro_year_range.size] = year_daily_glacier_fractions
+                day_idx = day_idx + hydro_year_range.size
+                with instrument_stage(stage_records, 'write', year, days=hydro_year_range.size):
+                    write_daily_zonal_statistics(zonal_statistics_files, annual_store, year, hydro_year_range, ablation_start, dat_precision, dat_chunk_size)
+        
+        with instrument_stage(stage_records, 'initialize_dataframe'):
+            daily_HRU_glacier_evolution_df = initialize_dataframe(daily_glacier_fractions, daily_dates, HRUs_ID_ice)
+        
+        print("\nProcessed glacierized HRUs daily evolution dataframe: " + str(daily_HRU_glacier_evolution_df))
         
-    # We add the raw annual data to the matrix
-    raw_HRU_glacier_evolution = np.vstack((raw_HRU_glacier_evolution, current_year))
+        with instrument_stage(stage_records, 'write', days=daily_dates.size):
+            # Save output in file to be read by J2K
+            if('dat' in output_formats):
+                if(dat_writer == 'pandas'):
+                    daily_HRU_glacier_evolution_df.to_csv(output_path + '.dat', sep=' ', index_label = 'date', lineterminator='\n', float_format=None if dat_precision is None else '%.' + str(int(dat_precision)) + 'f')
+                else:
+                    write_dat(daily_glacier_fractions, daily_dates, HRUs_ID_ice, output_path + '.dat', dat_precision, dat_chunk_size)
+            
+            # Binary outputs for QA and post-processing
+            if('npy' in output_formats):
+                write_npy(daily_glacier_fractions, daily_dates, HRUs_ID_ice, output_path)
+            if('parquet' in output_formats):
+                write_parquet(daily_HRU_glacier_evolution_df, output_path)
     
-    # We add the daily dataframe with the current year to the full daily dataframe
-    if(not isFirst):
-        interp_annual_ice_fraction = np.asarray(interp_annual_ice_fraction)
-        if(initDF):
-            daily_HRU_glacier_evolution_df = initialize_dataframe(interp_annual_ice_fraction, hydro_year_range)
-            initDF = False
-        else:
-            new_year_dataframe = initialize_dataframe(interp_annual_ice_fraction, hydro_year_range)
-            daily_HRU_glacier_evolution_df = daily_HRU_glacier_evolution_df.append(new_year_dataframe)
+    # Annual zonal statistics, dated at the end of each hydrological year
+    for zonal_statistic_file in zonal_statistics_files.values():
+        zonal_statistic_file.close()
+    if(zonal_statistics_frequency == 'annual'):
+        annual_dates = pd.DatetimeIndex([pd.Timestamp(int(year), 9, 30) for year in years])
+        for statistic, zonal_statistic_path in zonal_statistics_paths.items():
+            write_dat(get_annual_zonal_statistic(annual_store, statistic), annual_dates, HRUs_ID_ice, zonal_statistic_path, dat_precision, dat_chunk_size)
     
-    isFirst = False
-
-# We add the raw data into the original annual dataframe
-HRU_evolution_df = pd.DataFrame(index= raw_HRU_glacier_evolution[1:,0], columns=raw_HRU_glacier_evolution[0,1:], data=raw_HRU_glacier_evolution[1:,1:])
+    if(use_cache):
+        evict_cache(glacier_fractions_cache_path, max_cache_size)
+    
+    if(profile_run):
+        profiler.disable()
+        profiler.dump_stats(output_path + '.prof')
+    
+    run_report = None
+    if(write_run_report):
+        counters = {'ice_HRUs': int(HRUs_ID_ice.size), 'years': len(years), 
+                    'years_computed': len(set(stage_record['year'] for stage_record in stage_records if stage_record['stage'] in ['alignment', 'overlap_reduction'])),
+                    'days_emitted': int(day_idx)}
+        config = {'alignment_mode': alignment_mode, 'tiled': tiled, 'n_workers': n_workers, 'n_prefetch': n_prefetch, 'use_cache': use_cache, 'streaming': streaming, 'output_formats': output_formats, 
+                  'compute_backend': compute_backend, 'zonal_statistics': zonal_statistics, 'zonal_statistics_frequency': zonal_statistics_frequency}
+        run_report = summarize_run_report(stage_records, counters, config)
+        with open(output_path + '_run_report.json', 'w') as run_report_file:
+            json.dump(run_report, run_report_file, indent=2)
+    
+    # Annual glacier fractions of all the years, also available in streaming mode
+    HRU_evolution_df = get_annual_dataframe(annual_store)
+    
+    return {'output_path': output_path, 'years': years, 'HRUs_ID_ice': HRUs_ID_ice, 'run_report': run_report,
+            'daily_HRU_glacier_evolution_df': daily_HRU_glacier_evolution_df, 'HRU_evolution_df': HRU_evolution_df, 
+            'zonal_statistics_paths': zonal_statistics_paths, 
+            'HRU_zonal_statistics_dfs': {statistic: get_annual_dataframe(annual_store, statistic) for statistic in zonal_statistics}}
 
-print("\nProcessed glacierized HRUs daily evolution dataframe: " + str(daily_HRU_glacier_evolution_df))
+def parse_arguments(argv=None):
+    # Command line options, defaulting to the folders of the current working directory and the default options above
+    parser = argparse.ArgumentParser(description='Daily glacierized fraction of the J2K HRUs from annual glacier ice thickness rasters')
+    parser.add_argument('--workspace', default=os.getcwd(), help='catchment folder with the HRUs, glacier_thickness and HRU_glacier_fractions subfolders')
+    parser.add_argument('--hru-path', help='folder with hru_cat.tif and hru_landuse.tif')
+    parser.add_argument('--glacier-thickness-path', help='folder with the IceDepth_Glacier_<ID>_<year>.tif rasters')
+    parser.add_argument('--output-path', help='folder of the HRU_glacier_fractions_<first year>_<last year> outputs')
+    parser.add_argument('--aligned-path', help='folder of the VRT files (vrt alignment mode)')
+    parser.add_argument('--overlap-matrices-path', help='folder of the overlap matrices (overlap alignment mode)')
+    parser.add_argument('--cache-path', help='folder of the annual glacier fractions cache')
+    parser.add_argument('--alignment-mode', choices=['in_memory', 'vrt', 'overlap'], default=alignment_mode)
+    parser.add_argument('--tiled', action='store_true', default=tiled)
+    parser.add_argument('--min-tile-size', type=int, default=min_tile_size)
+    parser.add_argument('--n-workers', type=int, default=n_workers)
+    parser.add_argument('--prefetch', dest='n_prefetch', type=int, default=n_prefetch, help='years of rasters read in background threads while the current year is computed (serial runs, 0 = no prefetching)')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false', default=use_cache)
+    parser.add_argument('--max-cache-size', type=int, default=max_cache_size)
+    parser.add_argument('--clear-cache', action='store_true', help='clear the annual glacier fractions cache and exit')
+    parser.add_argument('--output-formats', nargs='+', choices=['dat', 'npy', 'parquet'], default=output_formats)
+    parser.add_argument('--dat-writer', choices=['fast', 'pandas'], default=dat_writer)
+    parser.add_argument('--dat-precision', type=int, default=dat_precision)
+    parser.add_argument('--dat-chunk-size', type=int, default=dat_chunk_size)
+    parser.add_argument('--streaming', action='store_true', default=streaming)
+    parser.add_argument('--no-run-report', dest='write_run_report', action='store_false', default=write_run_report)
+    parser.add_argument('--profile', dest='profile_run', action='store_true', default=profile_run)
+    parser.add_argument('--backend', dest='compute_backend', choices=['numba', 'numpy'], default=compute_backend)
+    parser.add_argument('--zonal-statistics', nargs='+', choices=zonal_statistic_names, default=zonal_statistics, help='extra per-HRU statistics written next to the glacier fractions')
+    parser.add_argument('--zonal-statistics-frequency', choices=['annual', 'daily'], default=zonal_statistics_frequency)
+    parser.add_argument('--ablation-start', default='%02d-%02d' % ablation_start, help='MM-DD start of the ablation season')
+    
+    return parser.parse_args(argv)
 
-# Save output in file to be read by J2K
-daily_HRU_glacier_evolution_df.to_csv(hru_glacier_fractions_path + "HRU_glacier_fractions_" + str(HRU_evolution_df.index.min()) + "_" + str(HRU_evolution_df.index.max()) + '.dat', sep=' ', index_label = 'date')
-   
+def main(argv=None):
+    args = parse_arguments(argv)
+    default_paths = get_default_paths(args.workspace)
+    glacier_thickness_path = args.glacier_thickness_path or default_paths['original_glacier_thickness_path']
     
+    # The intermediate folders default to subfolders of the glacier thickness folder
+    intermediate_paths = get_intermediate_paths(glacier_thickness_path)
+    if(args.clear_cache):
+        clear_cache(args.cache_path or intermediate_paths['glacier_fractions_cache_path'])
+        return
     
+    ablation_month, ablation_day = args.ablation_start.split('-')
     
-    
\ No newline at end of file
+    run_glacier_hru_evolution(args.hru_path or default_paths['hru_path'], glacier_thickness_path, args.output_path or default_paths['hru_glacier_fractions_path'], 
+                              aligned_glacier_thickness_path=args.aligned_path or intermediate_paths['aligned_glacier_thickness_path'], 
+                              overlap_matrices_path=args.overlap_matrices_path or intermediate_paths['overlap_matrices_path'], 
+                              glacier_fractions_cache_path=args.cache_path or intermediate_paths['glacier_fractions_cache_path'], alignment_mode=args.alignment_mode, tiled=args.tiled, 
+                              min_tile_size=args.min_tile_size, n_workers=args.n_workers, n_prefetch=args.n_prefetch, use_cache=args.use_cache, max_cache_size=args.max_cache_size, 
+                              output_formats=args.output_formats, dat_writer=args.dat_writer, dat_precision=args.dat_precision, dat_chunk_size=args.dat_chunk_size, 
+                              streaming=args.streaming, write_run_report=args.write_run_report, profile_run=args.profile_run, 
+                              ablation_start=(int(ablation_month), int(ablation_day)), compute_backend=args.compute_backend, 
+                              zonal_statistics=args.zonal_statistics, zonal_statistics_frequency=args.zonal_statistics_frequency)
+
+if __name__ == '__main__':
+    main()
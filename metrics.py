@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+@author: Jordi Bolibar
+Institut des Géosciences de l'Environnement (Université Grenoble Alpes)
+jordi.bolibar@univ-grenoble-alpes.fr
+
+PERFORMANCE METRICS OF MANY J2K SIMULATIONS AGAINST A SINGLE OBSERVED RUNOFF SERIES
+
+"""
+
+import numpy as np
+
+###############################################################################
+###                           FUNCTIONS                                     ###
+###############################################################################
+
+def get_valid_mask(simulations, evaluation, mask=None):
+    # Days used for each run: observed (no NaN gap) and within the optional day mask
+    valid = ~np.isnan(evaluation)
+    if(mask is not None):
+        valid = valid & np.asarray(mask, dtype=bool)
+
+    return np.broadcast_to(valid[np.newaxis, :], simulations.shape)
+
+def evaluate_runs(simulations, evaluation, mask=None):
+    # KGE (with its r, alpha and beta components), NSE, RMSE and bias of each simulation run (rows of a runs x days array)
+    # against the observations (days), computed for all the runs at once.
+    # Days with a NaN observation, or outside the optional day mask, are left out. As in hydroeval, a NaN simulated day
+    # is kept and makes the metrics of its run NaN
+    simulations = np.atleast_2d(np.asarray(simulations, dtype=np.float64))
+    evaluation = np.asarray(evaluation, dtype=np.float64)
+    valid = get_valid_mask(simulations, evaluation, mask)
+    n_days = valid.sum(axis=1)
+
+    # Masked days are set to 0 and left out of the sums
+    sim = np.where(valid, simulations, 0.)
+    obs = np.where(valid, evaluation[np.newaxis, :], 0.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sim_mean = sim.sum(axis=1)/n_days
+        obs_mean = obs.sum(axis=1)/n_days
+        sim_anomaly = np.where(valid, sim - sim_mean[:, np.newaxis], 0.)
+        obs_anomaly = np.where(valid, obs - obs_mean[:, np.newaxis], 0.)
+        sim_ss = np.sum(sim_anomaly**2, axis=1)
+        obs_ss = np.sum(obs_anomaly**2, axis=1)
+        squared_error = np.sum((obs - sim)**2, axis=1)
+
+        # Kling-Gupta Efficiency
+        r = np.sum(sim_anomaly*obs_anomaly, axis=1)/np.sqrt(sim_ss*obs_ss)
+        alpha = np.sqrt(sim_ss/n_days)/np.sqrt(obs_ss/n_days)
+        beta = sim.sum(axis=1)/obs.sum(axis=1)
+        kge = 1 - np.sqrt((r - 1)**2 + (alpha - 1)**2 + (beta - 1)**2)
+
+        # Nash-Sutcliffe Efficiency, root mean square error and mean bias (simulation - observation)
+        nse = 1 - squared_error/obs_ss
+        rmse = np.sqrt(squared_error/n_days)
+        bias = sim_mean - obs_mean
+
+    return {'kge': kge, 'r': r, 'alpha': alpha, 'beta': beta, 'nse': nse, 'rmse': rmse, 'bias': bias, 'n_days': n_days}
+
+def get_season_masks(dates, season_dict):
+    # Day mask of each season, from a dictionary with the season of each month
+    seasons = sorted(set(season_dict.values()))
+    month_seasons = np.array([None] + [season_dict[month] for month in range(1, 13)])[np.asarray(dates.month)]
+
+    return {season: month_seasons == season for season in seasons}
+
+def evaluate_seasons(simulations, evaluation, dates, season_dict):
+    # Metrics of each run for the whole period ('all') and for each season
+    season_metrics = {'all': evaluate_runs(simulations, evaluation)}
+    for season, season_mask in get_season_masks(dates, season_dict).items():
+        season_metrics[season] = evaluate_runs(simulations, evaluation, season_mask)
+
+    return season_metrics